@@ -32,6 +32,29 @@ Commands:
    but keep ignored files
  - distclean: remove all files not tracked by the SCM
 
+Options:
+
+ - -v, --verbose: verbose mode
+ - -j N, --jobs N: run clone, pull, status, out, info and grep on N
+   repositories in parallel; the output of each repository is written at
+   once, in the order of the configuration. scan browses directories in N
+   threads (default: 8).
+
+Configuration: each line of the scm_config file has the format
+"directory: scm=url [option=value ...]". Options of git repositories, used
+by clone:
+
+ - depth=N: shallow clone, "git clone --depth N"
+ - filter=SPEC: partial clone, e.g. filter=blob:none
+ - reference=PATH: borrow objects from a local repository, "git clone
+   --reference PATH"; PATH is relative to the scm_config directory. If PATH
+   is a repository cloned by the same command, it is cloned first.
+ - shared=PATH: shared object cache, a bare repository created and managed
+   by scm.py at PATH. clone and pull first fetch the URLs of all
+   repositories using the cache into it, once per cache, and clone uses
+   "git clone --reference PATH": forks and mirrors of the same project
+   store and download common objects once.
+
 Programs needed at runtime:
 
  - patch
@@ -47,15 +70,29 @@ See also:
 - http://myrepos.branchable.com/
 - https://streakycobra.github.io/gws/
 """
+import bisect
+import collections
+import concurrent.futures
 import configparser
 import contextlib
+import hashlib
 import io
+import json
+import mmap
+import multiprocessing
 import os
 import re
 import shlex
 import shutil
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
 
 CLEAN_SUFFIXES = ('.orig', '.rej', '.bak', '.pyc', '.pyo')
 
@@ -64,6 +101,18 @@ assert COLORS in ("always", "never")
 STATUS_IGNORE_EXT = ".swp"
 STATUS_IGNORE_FILES = set(("tags",))
 DISTCLEAN_EXCLUDED_DIRS = ('.git', '.hg')
+# Directories not browsed by the scan command: they are big and don't
+# contain repositories
+SCAN_EXCLUDED_DIRS = frozenset((
+    '.git', '.hg', '.svn', 'node_modules', '__pycache__', '.tox', '.nox',
+    '.mypy_cache', '.pytest_cache', 'site-packages'))
+# Number of threads browsing directories, if -j is not used
+SCAN_JOBS = 8
+# Remember the subdirectories of each directory between two scans, until
+# the modification time of the directory changes
+USE_SCAN_CACHE = True
+SCAN_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME')
+                              or os.path.expanduser('~/.cache'), 'scm')
 
 PATCH_PROGRAM = 'patch'
 GREP_PROGRAM = 'grep'
@@ -80,6 +129,21 @@ CONFIG_FILENAME = "scm_config"
 STASH_FILENAME = 'stash'
 
 GREP = (GREP_PROGRAM, '-R', '-I', '-H', '-n', '--color=%s' % COLORS)
+# Maximum number of files per external grep command line
+GREP_MAX_FILES = 1000
+# Use the grep engine written in Python, rather than the external grep, for
+# the grep options it supports
+USE_GREP_ENGINE = True
+# Search files in worker processes if they contain more bytes
+GREP_PARALLEL_SIZE = 4 * 1024 * 1024
+# Number of file batches per worker process
+GREP_BATCHES_PER_WORKER = 4
+# GNU grep colors
+GREP_COLOR_FILENAME = '\x1b[35m\x1b[K'
+GREP_COLOR_LINENO = '\x1b[32m\x1b[K'
+GREP_COLOR_SEPARATOR = '\x1b[36m\x1b[K'
+GREP_COLOR_MATCH = '\x1b[01;31m\x1b[K'
+GREP_COLOR_END = '\x1b[m\x1b[K'
 
 HG_PULL = (HG_PROGRAM, 'pull', '--rebase')
 HG_HISTEDIT = (HG_PROGRAM, 'histedit')
@@ -97,15 +161,22 @@ HG_PUSH = (HG_PROGRAM, 'push')
 HG_BRANCH = (HG_PROGRAM, 'branch')
 HG_LIST_BRANCHES = (HG_PROGRAM, 'branches')
 HG_LIST_TAGS = (HG_PROGRAM, 'tags')
+HG_CMDSERVER = (HG_PROGRAM, 'serve', '--cmdserver', 'pipe',
+                '--config', 'ui.interactive=False')
+# Run hg commands whose output is parsed in a long-lived command server
+# process, rather than spawning a new hg process per command. Commands
+# writing into the terminal (colors, pager) always run in a new process.
+USE_HG_CMDSERVER = True
+HG_CMDSERVER_COMMANDS = frozenset(('branch', 'id', 'out', 'status'))
 
 GIT_PULL = ('pull', '--rebase')
 GIT_ADD = ('add',)
 GIT_COMMIT = ('commit', '-v', '--untracked-files=no')
 GIT_STATUS_PORCELAIN = ('status', '--porcelain')
+GIT_STATUS_SNAPSHOT = ('status', '--porcelain=v2', '--branch', '-z')
 GIT_CLONE = (GIT_PROGRAM, 'clone')
 GIT_LIST_BRANCHES = ('branch', '-l')
 GIT_LIST_TAGS = ('tag', '-l')
-GIT_GET_BRANCH = ('branch',)
 GIT_STASH = ('stash',)
 GIT_UNSTASH = ('stash', 'pop')
 GIT_REBASE_I = ('rebase', '-i')
@@ -115,8 +186,17 @@ GIT_REVERT_1 = ('reset', 'HEAD')
 GIT_REVERT_2 = ('checkout', '--')
 GIT_DIFF = ('diff',)
 GIT_LIST_FILES = ('ls-files',)
+# Read the Git index, HEAD and refs in Python for read-only commands, rather
+# than spawning git
+USE_GIT_READER = True
+# Cache the list of tracked files in the .git or .hg directory, until the
+# Git index or the Mercurial dirstate changes
+USE_TRACKED_FILES_CACHE = True
+TRACKED_FILES_CACHE = 'scm-files'
+TRACKED_FILES_MAGIC = 'scm-files 1'
 
 SHELL_REGEX = re.compile("^[a-zA-Z0-9_-]*$")
+REMOTE_NAME_REGEX = re.compile(r'[^A-Za-z0-9._-]+')
 
 
 def format_shell_arg(arg):
@@ -132,6 +212,21 @@ def format_shell_args(args):
     return ' '.join(format_shell_arg(arg) for arg in args)
 
 
+def get_remote_name(url):
+    """
+    Get a Git remote name from an URL.
+
+    >>> get_remote_name('https://github.com/python/cpython.git')
+    'github.com_python_cpython'
+    >>> get_remote_name('/home/me/mirrors/cpython/')
+    'home_me_mirrors_cpython'
+    """
+    name = re.sub('^[a-z+]+://', '', url).rstrip('/')
+    if name.endswith('.git'):
+        name = name[:-4]
+    return REMOTE_NAME_REGEX.sub('_', name).strip('_')
+
+
 def filesystem_sync():
     exitcode = subprocess.call('sync')
     if exitcode:
@@ -165,6 +260,14 @@ if not hasattr(os.path, 'relpath'):
     os.path.relpath = relpath
 
 
+def get_subprocess_env():
+    env = os.environ.copy()
+    for name in ('LC_ALL', 'LC_CTYPE', 'LANG'):
+        if name in env:
+            del env[name]
+    return env
+
+
 def split_ansi_colors(text):
     r"""
     >>> split_ansi_colors('\x1b[35m\x1b[Kprofile/packages\x1b[m\x1b[K\x1b[36m\x1b[K')
@@ -176,6 +279,357 @@ def split_ansi_colors(text):
     return m.groups()
 
 
+# Output buffer of the repository processed by the current thread
+_thread_output = threading.local()
+
+
+def get_output_buffer():
+    """
+    Return the output buffer of the current thread, or None if the output
+    is not buffered.
+    """
+    return getattr(_thread_output, 'buffer', None)
+
+
+class BufferedStream:
+    """
+    Wrapper to sys.stdout and sys.stderr: write into the output buffer of
+    the current thread, if any.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        buffer = get_output_buffer()
+        if buffer is not None:
+            return buffer.write(text)
+        return self._stream.write(text)
+
+    def flush(self):
+        if get_output_buffer() is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def format_duration(seconds):
+    """
+    >>> format_duration(75.2), format_duration(3725)
+    ('1:15', '1:02:05')
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%s:%02d:%02d' % (hours, minutes, seconds)
+    return '%s:%02d' % (minutes, seconds)
+
+
+class Progress:
+    """
+    Display the progress and the estimated remaining time (ETA) of a command
+    processing multiple repositories on stderr.
+
+    done() can be called from any thread.
+    """
+    def __init__(self, title, total):
+        self.title = title
+        self.total = total
+        self.count = 0
+        self.start_time = time.monotonic()
+        self._stream = sys.stderr
+        self._lock = threading.Lock()
+
+    def done(self, repository):
+        with self._lock:
+            self.count += 1
+            elapsed = time.monotonic() - self.start_time
+            line = ("%s: %s/%s repositories done (last: %s)"
+                    % (self.title, self.count, self.total, repository))
+            if self.count < self.total:
+                eta = elapsed / self.count * (self.total - self.count)
+                line += ", ETA: %s" % format_duration(eta)
+            else:
+                line += ", total: %s" % format_duration(elapsed)
+            print(line, file=self._stream, flush=True)
+
+
+class UnsupportedGrepOptions(Exception):
+    pass
+
+
+def convert_grep_regex(pattern, extended=False):
+    r"""
+    Convert a POSIX basic (BRE) or extended (ERE) regular expression, as
+    used by grep, to a Python regular expression.
+
+    >>> convert_grep_regex(r'a\(b\|c\)+')
+    'a(b|c)\\+'
+    >>> convert_grep_regex(r'\<word\>', extended=True)
+    '\\bword\\b'
+    >>> convert_grep_regex(r'[a\]')
+    '[a\\\\]'
+    >>> convert_grep_regex(r'[[&&~|]')
+    '[\\[\\&\\&\\~\\|]'
+    """
+    meta = '+?|(){}'
+    result = []
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        pos += 1
+        if char == '\\':
+            if pos >= len(pattern):
+                raise UnsupportedGrepOptions("trailing backslash")
+            char = pattern[pos]
+            pos += 1
+            if char in '<>':
+                result.append(r'\b')
+            elif char in meta and not extended:
+                result.append(char)
+            else:
+                result.append('\\' + char)
+        elif char == '[':
+            # Bracket expression: backslash is not special
+            end = pos
+            if end < len(pattern) and pattern[end] == '^':
+                end += 1
+            if end < len(pattern) and pattern[end] == ']':
+                end += 1
+            end = pattern.find(']', end)
+            if end < 0:
+                raise UnsupportedGrepOptions("unterminated bracket expression")
+            content = pattern[pos:end]
+            if any(seq in content for seq in ('[:', '[=', '[.')):
+                raise UnsupportedGrepOptions("unsupported bracket expression")
+            # Escape characters which are special in Python sets: backslash,
+            # nested sets and set operations (&&, ~~, ||, --)
+            converted = []
+            for index, char in enumerate(content):
+                if (char in '\\[&~|'
+                   or (char == '-' and index and content[index - 1] == '-')):
+                    converted.append('\\' + char)
+                else:
+                    converted.append(char)
+            result.append('[' + ''.join(converted) + ']')
+            pos = end + 1
+        elif char in meta and not extended:
+            result.append('\\' + char)
+        else:
+            result.append(char)
+    return ''.join(result)
+
+
+def parse_grep_args(args):
+    """
+    Parse grep options supported by the grep engine: return a compiled
+    bytes regex. Raise UnsupportedGrepOptions for other options.
+    """
+    patterns = []
+    flags = re.MULTILINE
+    extended = fixed = word = False
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '-e':
+            if not args:
+                raise UnsupportedGrepOptions("-e requires an argument")
+            patterns.append(args.pop(0))
+        elif arg == '--':
+            patterns.extend(args)
+            break
+        elif arg.startswith('-') and len(arg) > 1:
+            for option in arg[1:]:
+                if option == 'i':
+                    flags |= re.IGNORECASE
+                elif option == 'w':
+                    word = True
+                elif option == 'E':
+                    extended = True
+                elif option == 'F':
+                    fixed = True
+                else:
+                    raise UnsupportedGrepOptions("unsupported option: %s" % arg)
+        else:
+            patterns.append(arg)
+    if len(patterns) != 1:
+        raise UnsupportedGrepOptions("the grep engine only supports one pattern")
+    pattern = patterns[0]
+    if fixed:
+        regex = re.escape(pattern)
+    else:
+        regex = convert_grep_regex(pattern, extended)
+    if word:
+        regex = r'(?<!\w)(?:%s)(?!\w)' % regex
+    try:
+        return re.compile(os.fsencode(regex), flags)
+    except re.error as err:
+        raise UnsupportedGrepOptions("unsupported regex: %s" % err)
+
+
+def format_grep_line(filename, lineno, line, spans, colors):
+    r"""
+    Format a matching line as "grep -H -n --color".
+
+    >>> format_grep_line('a.py', 3, b'x = foo', [(4, 7)], False)
+    'a.py:3:x = foo'
+    """
+    line = line.decode('utf-8', 'replace')
+    if not colors:
+        return '%s:%s:%s' % (filename, lineno, line)
+    parts = []
+    pos = 0
+    for start, end in spans:
+        if start == end:
+            continue
+        parts.append(line[pos:start])
+        parts.append(GREP_COLOR_MATCH + line[start:end] + GREP_COLOR_END)
+        pos = end
+    parts.append(line[pos:])
+    separator = GREP_COLOR_SEPARATOR + ':' + GREP_COLOR_END
+    return ''.join((GREP_COLOR_FILENAME, filename, GREP_COLOR_END, separator,
+                    GREP_COLOR_LINENO, str(lineno), GREP_COLOR_END, separator,
+                    ''.join(parts)))
+
+
+def grep_file(regex, directory, filename, colors):
+    """
+    Search regex in a file, skip binary files (grep -I) and files which are
+    not regular files, like directories (symbolic link to a directory,
+    submodule).
+
+    Return (lines, found, error): output lines, True if the regex was found,
+    and an error message or None.
+    """
+    try:
+        fp = open(os.path.join(directory, filename), 'rb')
+    except IsADirectoryError:
+        return [], False, None
+    except OSError as err:
+        return [], False, "grep: %s: %s" % (filename, err.strerror)
+    with fp:
+        st = os.fstat(fp.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return [], False, None
+        size = st.st_size
+        if not size:
+            return [], False, None
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Binary file: contains a null byte
+            if data.find(b'\0') >= 0:
+                return [], False, None
+            lines = []
+            lineno = 1
+            counted = 0
+            pos = 0
+            while pos < size:
+                match = regex.search(data, pos)
+                if match is None or (match.start() == size and data[size - 1] == 0x0a):
+                    # No match, or an empty match after the last newline
+                    break
+                start = data.rfind(b'\n', 0, match.start()) + 1
+                end = data.find(b'\n', match.start())
+                if end < 0:
+                    end = size
+                # A match can span multiple lines: search in the line
+                line = data[start:end]
+                spans = [line_match.span() for line_match in regex.finditer(line)]
+                if spans:
+                    lineno += data[counted:start].count(b'\n')
+                    counted = start
+                    lines.append(format_grep_line(filename, lineno, line, spans, colors))
+                pos = end + 1
+    return lines, bool(lines), None
+
+
+def grep_batch(regex, directory, batch, colors):
+    """
+    Search regex in a batch of (index, filename): return a list of
+    (index, lines, found, error).
+    """
+    return [(index,) + grep_file(regex, directory, filename, colors)
+            for index, filename in batch]
+
+
+def split_grep_batches(directory, files, nbatch):
+    """
+    Split files into nbatch batches of about the same size: return
+    (batches, total_size), a batch is a list of (index, filename).
+    """
+    sizes = []
+    total_size = 0
+    for index, filename in enumerate(files):
+        try:
+            size = os.path.getsize(os.path.join(directory, filename))
+        except OSError:
+            size = 0
+        sizes.append((size, index, filename))
+        total_size += size
+    # Largest files first, each file goes into the smallest batch
+    sizes.sort(reverse=True)
+    batches = [[0, []] for _ in range(nbatch)]
+    for size, index, filename in sizes:
+        batch = min(batches, key=lambda batch: batch[0])
+        batch[0] += size
+        batch[1].append((index, filename))
+    return [batch for size, batch in batches if batch], total_size
+
+
+_grep_executor = None
+_grep_executor_lock = threading.Lock()
+
+
+def get_grep_executor():
+    global _grep_executor
+    with _grep_executor_lock:
+        if _grep_executor is None:
+            # The executor is created by a worker thread of -j N: don't fork
+            # a multithreaded process
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context('spawn')
+            _grep_executor = concurrent.futures.ProcessPoolExecutor(mp_context=context)
+        return _grep_executor
+
+
+def shutdown_grep_executor():
+    global _grep_executor
+    with _grep_executor_lock:
+        if _grep_executor is not None:
+            _grep_executor.shutdown()
+            _grep_executor = None
+
+
+def grep_files(regex, directory, files, colors):
+    """
+    Search regex in files: return (lines, found) where lines are the output
+    lines in the order of files. Errors are written into stderr.
+
+    Files are searched by worker processes in size-balanced batches if
+    there are enough data and CPUs.
+    """
+    ncpu = os.cpu_count() or 1
+    batches, total_size = split_grep_batches(directory, files,
+                                             ncpu * GREP_BATCHES_PER_WORKER)
+    if ncpu > 1 and total_size >= GREP_PARALLEL_SIZE and len(batches) > 1:
+        executor = get_grep_executor()
+        futures = [executor.submit(grep_batch, regex, directory, batch, colors)
+                   for batch in batches]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+    else:
+        results = grep_batch(regex, directory, enumerate(files), colors)
+    results.sort()
+    for index, file_lines, found, error in results:
+        if error:
+            print(error, file=sys.stderr)
+    lines = [line for index, file_lines, found, error in results for line in file_lines]
+    found = any(found for index, file_lines, found, error in results)
+    return lines, found
+
+
 def ask_confirmation(prompt):
     try:
         answer = input(prompt)
@@ -190,25 +644,44 @@ def ask_confirmation(prompt):
 class Application:
     def __init__(self):
         self._exitcode = 0
+        # set_exitcode() can be called by worker threads of -j N
+        self._exitcode_lock = threading.Lock()
         self.verbose = False
+        self.jobs = 1
         # Directory at program startup
         self.start_directory = os.path.realpath(os.getcwd())
         # Root of all repositories
         self.root = self.start_directory
         self.reset()
 
+    def parse_jobs(self, value):
+        try:
+            jobs = int(value)
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            print("Invalid number of jobs: %r" % value)
+            sys.exit(1)
+        self.jobs = jobs
+
     def main(self):
-        if len(sys.argv) < 2:
-            usage()
-        if sys.argv[1] in ('-v', '--verbose'):
-            self.verbose = True
-            if len(sys.argv) < 3:
+        args = sys.argv[1:]
+        while args and args[0].startswith('-'):
+            option = args.pop(0)
+            if option in ('-v', '--verbose'):
+                self.verbose = True
+            elif option in ('-j', '--jobs'):
+                if not args:
+                    usage()
+                self.parse_jobs(args.pop(0))
+            elif option.startswith('-j'):
+                self.parse_jobs(option[2:])
+            else:
                 usage()
-            self.command = sys.argv[2]
-            self.args = tuple(sys.argv[3:])
-        else:
-            self.command = sys.argv[1]
-            self.args = tuple(sys.argv[2:])
+        if not args:
+            usage()
+        self.command = args[0]
+        self.args = tuple(args[1:])
 
         try:
             self.process_command()
@@ -252,7 +725,11 @@ class Application:
         except KeyError:
             usage()
         else:
-            func()
+            try:
+                func()
+            finally:
+                for repository in self.repositories:
+                    repository.close()
 
     def noargs(self):
         if not self.args:
@@ -267,11 +744,149 @@ class Application:
     def clone(self):
         self.noargs()
         self.setup(need_config=True)
+        repositories = []
         for repository in self.repositories:
             if not repository.exists():
-                repository.clone()
+                repositories.append(repository)
             else:
                 print("Skip %s: already exists" % repository.name)
+        if not repositories:
+            return
+        self.update_shared_caches(repositories)
+
+        def clone_repository(repository):
+            try:
+                repository.clone()
+            except SystemExit as exc:
+                self.system_exit(exc)
+                return False
+            return True
+
+        progress = Progress("clone", len(repositories))
+        results = {}
+        pending = repositories
+        while pending:
+            # "git clone --reference PATH" must not start before the
+            # repository at PATH is cloned: clone referenced repositories
+            # first
+            cloning = set()
+            for repository in pending:
+                cloning.add(os.path.realpath(repository.root))
+                cloning.add(os.path.realpath(os.path.join(repository.root, '.git')))
+            ready = [repository for repository in pending
+                     if repository.get_reference() not in cloning]
+            if not ready:
+                for repository in pending:
+                    print("%s: cyclic reference between repositories" % repository)
+                    results[repository] = False
+                self.set_exitcode(1)
+                break
+            cloned = self.for_each_repository(clone_repository, ready,
+                                              progress=progress.done)
+            results.update(zip(ready, cloned))
+            pending = [repository for repository in pending
+                       if repository not in results]
+        for repository in repositories:
+            if not results[repository]:
+                print("Failed to clone: %s" % repository)
+
+    def update_shared_caches(self, repositories):
+        """
+        Fetch the remotes of repositories into their shared object cache,
+        once per cache, before repositories are cloned or pulled.
+        """
+        caches = {}
+        for repository in repositories:
+            path = repository.get_shared_cache()
+            if path is not None:
+                urls = caches.setdefault(path, [])
+                url = repository.get_url()
+                if url and url not in urls:
+                    urls.append(url)
+        for path, urls in caches.items():
+            cache = RepositoryGIT(self, path, gitdir=path)
+            try:
+                cache.update_shared_cache(urls)
+            except SystemExit as exc:
+                self.system_exit(exc)
+                print("Failed to update the shared cache: %s" % cache)
+
+    def _run_buffered(self, func, repository):
+        buffer = io.StringIO()
+        _thread_output.buffer = buffer
+        try:
+            try:
+                result = func(repository)
+            except SystemExit as exc:
+                return (None, exc, buffer.getvalue())
+            except Exception:
+                traceback.print_exc(file=buffer)
+                return (None, SystemExit(1), buffer.getvalue())
+            finally:
+                repository.close()
+            return (result, None, buffer.getvalue())
+        finally:
+            _thread_output.buffer = None
+
+    def for_each_repository(self, func, repositories, progress=None):
+        """
+        Call func(repository) on each repository and return the list of
+        results.
+
+        With -j N, run func on N repositories in parallel: the output of each
+        repository is buffered and written at once, in the order of
+        repositories. A failure (SystemExit or an exception) doesn't stop other
+        repositories: the result is None, the traceback of an exception is
+        written into the output of the repository, and failed repositories
+        are listed at the end.
+
+        If progress is set, progress(repository) is called when func
+        completes, as soon as it completes.
+
+        Repositories are closed when func completes.
+        """
+        repositories = list(repositories)
+        if self.jobs == 1 or len(repositories) <= 1:
+            results = []
+            for repository in repositories:
+                try:
+                    results.append(func(repository))
+                finally:
+                    repository.close()
+                if progress is not None:
+                    progress(repository)
+            return results
+
+        results = []
+        errors = []
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout = BufferedStream(stdout)
+        sys.stderr = BufferedStream(stderr)
+        executor = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        try:
+            futures = []
+            for repository in repositories:
+                future = executor.submit(self._run_buffered, func, repository)
+                if progress is not None:
+                    future.add_done_callback(
+                        lambda future, repository=repository: progress(repository))
+                futures.append(future)
+            for repository, future in zip(repositories, futures):
+                result, exc, output = future.result()
+                stdout.write(output)
+                stdout.flush()
+                if exc is not None:
+                    self.system_exit(exc)
+                    errors.append(repository)
+                results.append(result)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            sys.stdout, sys.stderr = stdout, stderr
+        for repository in errors:
+            print("Failed: %s" % repository)
+        return results
 
     def iter_existing_repositories(self):
         for repository in self.repositories:
@@ -314,9 +929,13 @@ class Application:
             sys.exit(1)
         self.setup()
         display_if_empty = self.verbose or self.only_one_local_scm()
-        found = False
-        for repository in self.iter_existing_repositories():
-            found |= repository.grep(self.args, display_if_empty=display_if_empty)
+        try:
+            results = self.for_each_repository(
+                lambda repository: repository.grep(self.args, display_if_empty=display_if_empty),
+                self.iter_existing_repositories())
+        finally:
+            shutdown_grep_executor()
+        found = any(results)
         if not found:
             self.set_exitcode(1)
 
@@ -332,6 +951,12 @@ class Application:
     def selftest(self):
         import doctest
         failures, ntests = doctest.testmod()
+        if shutil.which(GIT_PROGRAM):
+            errors = check_git_reader()
+            for error in errors:
+                print("GitReader error: %s" % error)
+            failures += len(errors)
+            ntests += 1
         if failures:
             self.set_exitcode(1)
         else:
@@ -340,10 +965,10 @@ class Application:
     def info(self):
         self.noargs()
         self.setup()
-        existing = 0
-        for repository in self.iter_existing_repositories():
-            repository.info()
-            existing += 1
+        results = self.for_each_repository(
+            lambda repository: repository.info(),
+            self.iter_existing_repositories())
+        existing = len(results)
         if self.has_config:
             text = "Total: %s repositories" % len(self.repositories)
             missing = len(self.repositories) - existing
@@ -354,8 +979,9 @@ class Application:
     def pull(self):
         self.noargs()
         self.setup()
-        errors = []
-        for repository in self.repositories:
+        self.update_shared_caches(self.repositories)
+
+        def pull_repository(repository):
             try:
                 if repository.exists():
                     repository.pull()
@@ -363,31 +989,38 @@ class Application:
                     repository.clone()
             except SystemExit as exc:
                 self.system_exit(exc)
-                errors.append(repository)
-        for repository in errors:
-            print("Failed to pull: %s" % repository)
+                return False
+            return True
+
+        results = self.for_each_repository(pull_repository, self.repositories)
+        for repository, pulled in zip(self.repositories, results):
+            if not pulled:
+                print("Failed to pull: %s" % repository)
 
     def status(self):
         if len(self.args) == 1:
             self.setup_local(use_args=True)
-            for repository in self.iter_existing_repositories():
-                repository.status(self.args)
+            args = self.args
         elif len(self.args) == 0:
             self.setup()
-            for repository in self.iter_existing_repositories():
-                repository.status(tuple())
+            args = tuple()
         else:
             print("status takes no argument or one argument, not %s" % len(self.args))
             sys.exit(1)
+        self.for_each_repository(lambda repository: repository.status(args),
+                                 self.iter_existing_repositories())
 
     def out(self):
         self.noargs()
         self.setup()
         display_if_empty = self.verbose or self.only_one_local_scm()
-        for repository in self.iter_existing_repositories():
+
+        def out(repository):
             print("Check repository %s" % repository, file=sys.stderr)
             repository.out(display_if_empty)
 
+        self.for_each_repository(out, self.iter_existing_repositories())
+
     def processing(self):
         if self.has_config:
             print("Processing %s repositories" % len(self.repositories))
@@ -428,7 +1061,9 @@ class Application:
             destdir, _, data = line.partition(':')
             destdir = destdir.rstrip()
             data = data.lstrip()
-            scm, _, url = data.partition('=')
+            scm, _, data = data.partition('=')
+            url, *options = data.split()
+            options = dict(option.split('=', 1) for option in options)
         except Exception as err:
             print("Unable to parse line %r: %s" % (line, err))
             sys.exit(1)
@@ -436,7 +1071,13 @@ class Application:
             if not destdir.startswith(filter_path):
                 return
         klass = SCM_CLASSES[scm]
+        for name in options:
+            if name not in klass.CLONE_OPTIONS:
+                print("Unable to parse line %r: unsupported %s option: %s"
+                      % (line, scm, name))
+                sys.exit(1)
         repository = klass(self, destdir, url=url)
+        repository.clone_options = options
         self.repositories.append(repository)
 
     def read_config(self, filename, filter_path=None):
@@ -595,10 +1236,11 @@ class Application:
         repository.tag_contains(revision)
 
     def set_exitcode(self, exitcode):
-        if self._exitcode is None:
-            self._exitcode = exitcode
-        elif exitcode != 0:
-            self._exitcode = exitcode
+        with self._exitcode_lock:
+            if self._exitcode is None:
+                self._exitcode = exitcode
+            elif exitcode != 0:
+                self._exitcode = exitcode
 
     def system_exit(self, exc):
         exitcode = exc.code
@@ -606,31 +1248,135 @@ class Application:
             exitcode = 1
         self.set_exitcode(exitcode)
 
-    def _scanner(self, directory):
-        ignored = 0
+    def _scan_directory(self, dirpath, cached):
+        """
+        List subdirectories of dirpath, or reuse the cached list if the
+        directory was not modified since the previous scan.
+
+        Return (entry, repository) where entry is (mtime_ns, subdirs,
+        has_scm), or (None, None) on error.
+        """
         try:
-            names = os.listdir(directory)
+            mtime = os.stat(dirpath).st_mtime_ns
         except OSError as err:
             print(("WARNING: Failed to browse %s directory: %s"
-                   % (directory, err)), file=sys.stderr)
-            return ignored
-        for name in names:
-            fullname = os.path.join(directory, name)
-            if not os.path.isdir(fullname):
-                continue
-            repository = self.parse_local_scm(fullname)
+                   % (dirpath, err)), file=sys.stderr)
+            return (None, None)
+        if cached is not None and cached[0] == mtime:
+            entry = cached
+        else:
+            subdirs = []
+            has_scm = False
+            try:
+                with os.scandir(dirpath) as it:
+                    for dir_entry in it:
+                        name = dir_entry.name
+                        if name in ('.git', '.hg'):
+                            has_scm = True
+                        if name in SCAN_EXCLUDED_DIRS:
+                            continue
+                        try:
+                            # Use d_type, but follow symbolic links
+                            if not dir_entry.is_dir():
+                                continue
+                        except OSError:
+                            continue
+                        subdirs.append(name)
+            except OSError as err:
+                print(("WARNING: Failed to browse %s directory: %s"
+                       % (dirpath, err)), file=sys.stderr)
+                return (None, None)
+            entry = (mtime, subdirs, has_scm)
+
+        repository = None
+        if entry[2] and dirpath != self.root:
+            repository = self.parse_local_scm(dirpath)
             if repository is not None:
-                url = repository.get_url()
-                if url is not None:
-                    self.repositories.append(repository)
-                    print("-> %s" % repository, file=sys.stderr)
-                else:
-                    print("IGNORE: %s (unable to get the parent)" % repository,
-                          file=sys.stderr)
-                    ignored += 1
-                continue
-            else:
-                ignored += self._scanner(fullname)
+                # Read the configuration in the worker thread
+                repository.get_url()
+        return (entry, repository)
+
+    def _get_scan_cache_filename(self):
+        key = hashlib.sha1(os.fsencode(self.root)).hexdigest()
+        return os.path.join(SCAN_CACHE_DIR, 'scan-%s.json' % key[:16])
+
+    def _load_scan_cache(self):
+        if not USE_SCAN_CACHE:
+            return {}
+        try:
+            with open(self._get_scan_cache_filename(), encoding='utf-8',
+                      errors='surrogateescape') as fp:
+                cache = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) or cache.get('root') != self.root:
+            return {}
+        return cache['directories']
+
+    def _save_scan_cache(self, directories):
+        if not USE_SCAN_CACHE:
+            return
+        filename = self._get_scan_cache_filename()
+        cache = {'root': self.root, 'directories': directories}
+        try:
+            os.makedirs(SCAN_CACHE_DIR, exist_ok=True)
+            fd, tmp_filename = tempfile.mkstemp(prefix='scan.', dir=SCAN_CACHE_DIR)
+            try:
+                with open(fd, 'w', encoding='utf-8', errors='surrogateescape') as fp:
+                    json.dump(cache, fp)
+                os.replace(tmp_filename, filename)
+            except BaseException:
+                os.unlink(tmp_filename)
+                raise
+        except OSError as err:
+            print("WARNING: Fail to write %s: %s" % (filename, err),
+                  file=sys.stderr)
+
+    def _scanner(self, directory):
+        """
+        Browse directories in a thread pool, starting at directory: a
+        directory containing a repository is not browsed.
+
+        Return the number of ignored repositories.
+        """
+        ignored = 0
+        cache = self._load_scan_cache()
+        new_cache = {}
+        racy_time = time.time_ns() - 2 * 10 ** 9
+        jobs = self.jobs if self.jobs > 1 else SCAN_JOBS
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            def submit(dirpath):
+                future = executor.submit(self._scan_directory, dirpath,
+                                         cache.get(dirpath))
+                pending[future] = dirpath
+
+            pending = {}
+            submit(directory)
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    dirpath = pending.pop(future)
+                    entry, repository = future.result()
+                    if entry is None:
+                        continue
+                    if entry[0] < racy_time:
+                        # Don't cache directories modified in the last 2
+                        # seconds: they may be modified again without
+                        # changing their modification time
+                        new_cache[dirpath] = entry
+                    if repository is not None:
+                        if repository.get_url() is not None:
+                            self.repositories.append(repository)
+                            print("-> %s" % repository, file=sys.stderr)
+                        else:
+                            print("IGNORE: %s (unable to get the parent)" % repository,
+                                  file=sys.stderr)
+                            ignored += 1
+                        continue
+                    for name in entry[1]:
+                        submit(os.path.join(dirpath, name))
+        self._save_scan_cache(new_cache)
         return ignored
 
     def scanner(self):
@@ -660,12 +1406,662 @@ class Application:
                   file=sys.stderr)
 
 
+class GitStatus:
+    """
+    Snapshot of a Git repository parsed from a single
+    "git status --porcelain=v2 --branch -z" command.
+
+    Attributes:
+
+    - branch: branch name, "(detached)" for a detached HEAD
+    - upstream: upstream branch name, or None
+    - ahead, behind: number of commits ahead and behind upstream
+    - changes: list of (XY, path, orig_path) of tracked files
+    - untracked: list of untracked paths
+
+    Paths are relative to the repository root.
+    """
+    def __init__(self):
+        self.branch = None
+        self.upstream = None
+        self.ahead = 0
+        self.behind = 0
+        self.changes = []
+        self.untracked = []
+
+    @classmethod
+    def parse(cls, output):
+        r"""
+        >>> status = GitStatus.parse('# branch.oid 1234\0# branch.head main\0'
+        ...     '# branch.upstream origin/main\0# branch.ab +2 -1\0'
+        ...     '1 .M N... 100644 100644 100644 1234 1234 a.py\0'
+        ...     '2 R. N... 100644 100644 100644 1234 1234 R100 new.py\0old.py\0'
+        ...     '? b.txt\0')
+        >>> status.branch, status.upstream, status.ahead, status.behind
+        ('main', 'origin/main', 2, 1)
+        >>> status.get_modified_files(), status.untracked
+        (['a.py', 'new.py'], ['b.txt'])
+        >>> print(status.format_porcelain())
+         M a.py
+        R  old.py -> new.py
+        ?? b.txt
+        """
+        status = cls()
+        records = iter(output.split('\0'))
+        for record in records:
+            if record.startswith('# '):
+                key, _, value = record[2:].partition(' ')
+                if key == 'branch.head':
+                    status.branch = value
+                elif key == 'branch.upstream':
+                    status.upstream = value
+                elif key == 'branch.ab':
+                    ahead, behind = value.split()
+                    status.ahead = int(ahead)
+                    status.behind = -int(behind)
+            elif record.startswith('1 '):
+                fields = record.split(' ', 8)
+                status.changes.append((fields[1], fields[8], None))
+            elif record.startswith('2 '):
+                fields = record.split(' ', 9)
+                # The original path is the next record
+                status.changes.append((fields[1], fields[9], next(records)))
+            elif record.startswith('u '):
+                fields = record.split(' ', 10)
+                status.changes.append((fields[1], fields[10], None))
+            elif record.startswith('? '):
+                status.untracked.append(record[2:])
+        return status
+
+    def get_modified_files(self):
+        return [path for xy, path, orig_path in self.changes]
+
+    def format_porcelain(self):
+        """
+        Format the status as "git status --porcelain" (v1).
+        """
+        lines = []
+        for xy, path, orig_path in self.changes:
+            xy = xy.replace('.', ' ')
+            if orig_path is not None:
+                lines.append("%s %s -> %s" % (xy, orig_path, path))
+            else:
+                lines.append("%s %s" % (xy, path))
+        for path in self.untracked:
+            lines.append("?? %s" % path)
+        return '\n'.join(lines)
+
+
+class UnsupportedGitRepository(Exception):
+    pass
+
+
+GitIndexEntry = collections.namedtuple('GitIndexEntry',
+    'path ctime mtime dev ino mode uid gid size flags extended_flags')
+
+GIT_INDEX_ENTRY = struct.Struct('>10I20sH')
+# Entry flags
+GIT_ASSUME_VALID = 0x8000
+GIT_EXTENDED = 0x4000
+# Extended entry flags
+GIT_SKIP_WORKTREE = 0x4000
+GIT_INTENT_TO_ADD = 0x2000
+GIT_MODE_GITLINK = 0o160000
+GIT_OID_SIZE = 20
+# Git objects stored in a pack file
+GIT_OBJ_COMMIT = 1
+
+
+def parse_git_index(data):
+    r"""
+    Parse the content of a Git index file (DIRC format, version 2 or 3).
+
+    Return (entries, extensions) where extensions is a dict: signature =>
+    data. Raise UnsupportedGitRepository on an unsupported index.
+
+    >>> entry = GIT_INDEX_ENTRY.pack(1, 2, 3, 4, 0, 42, 0o100644, 0, 0, 5,
+    ...                              bytes(20), len('a.txt')) + b'a.txt'
+    >>> entry += bytes(8 - len(entry) % 8)
+    >>> data = b'DIRC' + struct.pack('>II', 2, 1) + entry + bytes(20)
+    >>> entries, extensions = parse_git_index(data)
+    >>> [(entry.path, entry.mtime, entry.size) for entry in entries]
+    [(b'a.txt', (3, 4), 5)]
+    >>> parse_git_index(b'DIRC' + struct.pack('>II', 4, 0) + bytes(20))
+    Traceback (most recent call last):
+      ...
+    UnsupportedGitRepository: unsupported index version 4
+    """
+    signature, version, count = struct.unpack_from('>4sII', data)
+    if signature != b'DIRC':
+        raise UnsupportedGitRepository("invalid index signature: %r" % signature)
+    if version not in (2, 3):
+        raise UnsupportedGitRepository("unsupported index version %s" % version)
+    # Ignore the trailing checksum
+    end = len(data) - GIT_OID_SIZE
+    pos = 12
+    entries = []
+    for _ in range(count):
+        fields = GIT_INDEX_ENTRY.unpack_from(data, pos)
+        flags = fields[11]
+        start = pos
+        pos += GIT_INDEX_ENTRY.size
+        extended_flags = 0
+        if flags & GIT_EXTENDED:
+            extended_flags, = struct.unpack_from('>H', data, pos)
+            pos += 2
+        name_end = data.index(b'\0', pos)
+        path = data[pos:name_end]
+        # Entries are padded with 1 to 8 NUL bytes to a multiple of 8 bytes
+        pos = start + ((name_end - start) // 8 + 1) * 8
+        if (flags >> 12) & 3:
+            raise UnsupportedGitRepository("unmerged entry: %r" % path)
+        entries.append(GitIndexEntry(path,
+                                     (fields[0], fields[1]),
+                                     (fields[2], fields[3]),
+                                     fields[4], fields[5], fields[6],
+                                     fields[7], fields[8], fields[9],
+                                     flags, extended_flags))
+
+    extensions = {}
+    while pos < end:
+        signature, size = struct.unpack_from('>4sI', data, pos)
+        pos += 8
+        if signature[:1].islower():
+            # Required extension: split index, sparse index, etc.
+            raise UnsupportedGitRepository("unsupported index extension %r" % signature)
+        extensions[signature] = data[pos:pos + size]
+        pos += size
+    return entries, extensions
+
+
+def parse_git_cache_tree_root(data):
+    r"""
+    Get the tree object identifier of the root directory from the cache tree
+    ("TREE" index extension): return None if the root is invalidated.
+
+    >>> parse_git_cache_tree_root(b'\0' + b'2 0\n' + bytes(20))
+    '0000000000000000000000000000000000000000'
+    >>> parse_git_cache_tree_root(b'\0' + b'-1 0\n')
+    """
+    path_end = data.index(b'\0')
+    line_end = data.index(b'\n', path_end)
+    entry_count = int(data[path_end + 1:line_end].split()[0])
+    if data[:path_end] or entry_count < 0:
+        return None
+    return data[line_end + 1:line_end + 1 + GIT_OID_SIZE].hex()
+
+
+def git_needs_quoting(path):
+    """
+    Return True if "git ls-files" quotes the path (core.quotePath).
+    """
+    return any(byte < 0x20 or byte >= 0x7f or byte in b'"\\' for byte in path)
+
+
+class GitReader:
+    """
+    Read the Git index, HEAD, refs and commits of a repository in Python.
+
+    Methods raise UnsupportedGitRepository if git must be used instead.
+    """
+    def __init__(self, gitdir):
+        if os.path.isfile(gitdir):
+            # "gitdir: PATH" file of a worktree or a submodule
+            with open(gitdir) as fp:
+                line = fp.readline().rstrip()
+            if not line.startswith('gitdir: '):
+                raise UnsupportedGitRepository("invalid gitdir file: %s" % gitdir)
+            gitdir = os.path.join(os.path.dirname(gitdir), line[8:])
+        self.gitdir = gitdir
+        # HEAD is per worktree, but refs and objects are in the common
+        # directory
+        try:
+            with open(os.path.join(gitdir, 'commondir')) as fp:
+                commondir = fp.read().strip()
+        except FileNotFoundError:
+            commondir = os.curdir
+        self.commondir = os.path.normpath(os.path.join(gitdir, commondir))
+        self._index = None
+        self._ref_storage_checked = False
+
+    def read_index(self):
+        """
+        Return (index_mtime, entries, extensions).
+        """
+        if self._index is None:
+            filename = os.path.join(self.gitdir, 'index')
+            with open(filename, 'rb') as fp:
+                st = os.fstat(fp.fileno())
+                data = fp.read()
+            entries, extensions = parse_git_index(data)
+            self._index = (st.st_mtime_ns, entries, extensions)
+        return self._index
+
+    def list_files(self):
+        index_mtime, entries, extensions = self.read_index()
+        files = []
+        for entry in entries:
+            if git_needs_quoting(entry.path):
+                raise UnsupportedGitRepository("path needs quoting: %r" % entry.path)
+            files.append(entry.path.decode('utf-8'))
+        return files
+
+    def _check_ref_storage(self):
+        """
+        Raise UnsupportedGitRepository if refs are not stored in files,
+        ex: reftable.
+        """
+        if self._ref_storage_checked:
+            return
+        filename = os.path.join(self.commondir, 'config')
+        parser = configparser.RawConfigParser(strict=False)
+        try:
+            with open(filename) as fp:
+                lines = [line.strip() for line in fp]
+            parser.read_string('\n'.join(lines), filename)
+        except FileNotFoundError:
+            return
+        except configparser.Error as err:
+            raise UnsupportedGitRepository("failed to parse %s: %s" % (filename, err))
+        if parser.has_option('extensions', 'refstorage'):
+            storage = parser.get('extensions', 'refstorage')
+            raise UnsupportedGitRepository("unsupported ref storage: %s" % storage)
+        self._ref_storage_checked = True
+
+    def read_head(self):
+        with open(os.path.join(self.gitdir, 'HEAD')) as fp:
+            head = fp.read().strip()
+        # With reftable, HEAD is a placeholder and the config enables the
+        # refStorage extension
+        if head == 'ref: refs/heads/.invalid':
+            raise UnsupportedGitRepository("unsupported ref storage (HEAD: %r)" % head)
+        self._check_ref_storage()
+        return head
+
+    def get_branch(self):
+        head = self.read_head()
+        if not head.startswith('ref: '):
+            return '(detached)'
+        ref = head[5:]
+        if not ref.startswith('refs/heads/'):
+            raise UnsupportedGitRepository("unsupported HEAD: %r" % head)
+        return ref[len('refs/heads/'):]
+
+    def resolve_ref(self, ref):
+        """
+        Get the object identifier of a ref, from a loose ref or packed-refs.
+        """
+        for _ in range(5):
+            try:
+                with open(os.path.join(self.commondir, ref)) as fp:
+                    value = fp.read().strip()
+            except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+                value = self._read_packed_ref(ref)
+            if not value.startswith('ref: '):
+                return value
+            ref = value[5:]
+        raise UnsupportedGitRepository("too many symbolic refs: %s" % ref)
+
+    def _read_packed_ref(self, ref):
+        try:
+            with open(os.path.join(self.commondir, 'packed-refs')) as fp:
+                for line in fp:
+                    if line.startswith(('#', '^')):
+                        continue
+                    oid, _, name = line.rstrip('\n').partition(' ')
+                    if name == ref:
+                        return oid
+        except FileNotFoundError:
+            pass
+        raise UnsupportedGitRepository("unknown ref: %s" % ref)
+
+    def resolve_head(self):
+        head = self.read_head()
+        if head.startswith('ref: '):
+            return self.resolve_ref(head[5:])
+        return head
+
+    def _read_loose_object(self, oid):
+        filename = os.path.join(self.commondir, 'objects', oid[:2], oid[2:])
+        try:
+            with open(filename, 'rb') as fp:
+                data = zlib.decompress(fp.read())
+        except FileNotFoundError:
+            return None
+        header, _, content = data.partition(b'\0')
+        obj_type = header.split(b' ', 1)[0]
+        return obj_type, content
+
+    def _read_packed_object(self, oid):
+        binary_oid = bytes.fromhex(oid)
+        packdir = os.path.join(self.commondir, 'objects', 'pack')
+        try:
+            names = os.listdir(packdir)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if not name.endswith('.idx'):
+                continue
+            with open(os.path.join(packdir, name), 'rb') as fp:
+                idx = fp.read()
+            if idx[:8] != b'\377tOc\0\0\0\2':
+                raise UnsupportedGitRepository("unsupported pack index: %s" % name)
+            fanout = struct.unpack_from('>256I', idx, 8)
+            count = fanout[255]
+            oids_pos = 8 + 256 * 4
+            first = binary_oid[0]
+            lo = fanout[first - 1] if first else 0
+            hi = fanout[first]
+
+            oids = _PackIndexOids(idx, oids_pos)
+            index = bisect.bisect_left(oids, binary_oid, lo, hi)
+            if index >= hi or oids[index] != binary_oid:
+                continue
+            offsets_pos = oids_pos + count * (GIT_OID_SIZE + 4)
+            offset, = struct.unpack_from('>I', idx, offsets_pos + index * 4)
+            if offset & 0x80000000:
+                large_pos = offsets_pos + count * 4 + (offset & 0x7fffffff) * 8
+                offset, = struct.unpack_from('>Q', idx, large_pos)
+
+            with open(os.path.join(packdir, name[:-4] + '.pack'), 'rb') as fp:
+                fp.seek(offset)
+                header = fp.read(32)
+                obj_type = (header[0] >> 4) & 7
+                pos = 0
+                while header[pos] & 0x80:
+                    pos += 1
+                if obj_type != GIT_OBJ_COMMIT:
+                    # Deltified object
+                    raise UnsupportedGitRepository("unsupported packed object type %s" % obj_type)
+                fp.seek(offset + pos + 1)
+                decompressor = zlib.decompressobj()
+                content = b''
+                while not decompressor.eof:
+                    chunk = fp.read(4096)
+                    if not chunk:
+                        break
+                    content += decompressor.decompress(chunk)
+            return b'commit', content
+        return None
+
+    def read_commit_tree(self, oid):
+        """
+        Get the tree object identifier of a commit.
+        """
+        obj = self._read_loose_object(oid)
+        if obj is None:
+            obj = self._read_packed_object(oid)
+        if obj is None or obj[0] != b'commit':
+            raise UnsupportedGitRepository("commit not found: %s" % oid)
+        line = obj[1].split(b'\n', 1)[0]
+        if not line.startswith(b'tree '):
+            raise UnsupportedGitRepository("invalid commit: %s" % oid)
+        return line[5:].decode('ascii')
+
+    def is_clean(self, root):
+        """
+        Return True if tracked files have no local change, based on the cache
+        tree of the index and on file metadata (stat).
+
+        Raise UnsupportedGitRepository if git must check the repository.
+        """
+        index_mtime, entries, extensions = self.read_index()
+        tree = parse_git_cache_tree_root(extensions.get(b'TREE', b'\0-1 0\n'))
+        if tree is None:
+            raise UnsupportedGitRepository("the cache tree is invalidated")
+        if tree != self.read_commit_tree(self.resolve_head()):
+            raise UnsupportedGitRepository("the index differs from HEAD")
+        for entry in entries:
+            if entry.flags & GIT_ASSUME_VALID or entry.extended_flags & GIT_SKIP_WORKTREE:
+                continue
+            if entry.extended_flags & GIT_INTENT_TO_ADD or entry.mode == GIT_MODE_GITLINK:
+                raise UnsupportedGitRepository("%r must be checked by git" % entry.path)
+            mtime_ns = entry.mtime[0] * 10 ** 9 + entry.mtime[1]
+            if mtime_ns >= index_mtime:
+                # "Racily clean" entry: the file may have been modified after
+                # the index was written
+                raise UnsupportedGitRepository("racily clean entry: %r" % entry.path)
+            try:
+                st = os.lstat(os.path.join(os.fsencode(root), entry.path))
+            except OSError:
+                return False
+            if (st.st_size & 0xffffffff != entry.size
+               or st.st_mtime_ns != mtime_ns
+               or st.st_ctime_ns != entry.ctime[0] * 10 ** 9 + entry.ctime[1]
+               or st.st_ino & 0xffffffff != entry.ino
+               or (st.st_mode & 0o170000) != (entry.mode & 0o170000)):
+                # Maybe only touched: let git compare the content
+                raise UnsupportedGitRepository("%r metadata changed" % entry.path)
+        return True
+
+
+def check_git_reader():
+    """
+    Compare GitReader results with git in a temporary repository: return
+    the list of errors.
+
+    is_clean() can raise UnsupportedGitRepository to let git decide, but it
+    must never return a result different than git.
+    """
+    errors = []
+
+    def git(*args):
+        cmd = (GIT_PROGRAM, '-c', 'user.name=scm', '-c', 'user.email=scm@localhost',
+               '-c', 'init.defaultBranch=main') + args
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              cwd=root, check=True, universal_newlines=True)
+        return proc.stdout
+
+    old = time.time() - 60
+
+    def set_old_mtime():
+        # Avoid "racily clean" entries: files are older than the index.
+        # Only touch new files, since utime() also changes the ctime.
+        for name in os.listdir(root):
+            filename = os.path.join(root, name)
+            if name != '.git' and os.stat(filename).st_mtime > old:
+                os.utime(filename, (old, old))
+
+    def check(state, gitdir, expect_clean=None):
+        reader = GitReader(gitdir)
+        files = sorted(reader.list_files())
+        expected = sorted(git('ls-files', '-z').split('\0')[:-1])
+        if files != expected:
+            errors.append("%s: list_files() = %r, git: %r" % (state, files, expected))
+        branch = reader.get_branch()
+        expected = git('rev-parse', '--abbrev-ref', 'HEAD').strip()
+        if expected == 'HEAD':
+            expected = '(detached)'
+        if branch != expected:
+            errors.append("%s: get_branch() = %r, git: %r" % (state, branch, expected))
+        try:
+            clean = reader.is_clean(root)
+        except UnsupportedGitRepository:
+            clean = None
+        expected = not git('status', '--porcelain', '--untracked-files=no')
+        if clean is not None and clean != expected:
+            errors.append("%s: is_clean() = %r, git: %r" % (state, clean, expected))
+        if expect_clean is not None and clean != expect_clean:
+            errors.append("%s: is_clean() = %r, expected: %r" % (state, clean, expect_clean))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = os.path.join(tmpdir, 'repo')
+        os.mkdir(root)
+        git('init', '--quiet')
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            with open(os.path.join(root, name), 'w') as fp:
+                fp.write(name + '\n')
+        set_old_mtime()
+        git('add', '.')
+        git('commit', '--quiet', '-m', 'init')
+        gitdir = os.path.join(root, '.git')
+        check('clean', gitdir, True)
+
+        # Relative gitdir, and "gitdir: PATH" file with a relative path
+        old_cwd = os.getcwd()
+        os.chdir(root)
+        try:
+            check('relative gitdir', '.git', True)
+        finally:
+            os.chdir(old_cwd)
+        gitfile = os.path.join(tmpdir, 'gitfile')
+        with open(gitfile, 'w') as fp:
+            fp.write('gitdir: repo/.git\n')
+        check('gitdir file', gitfile, True)
+
+        with open(os.path.join(root, 'a.txt'), 'a') as fp:
+            fp.write('modified\n')
+        check('modified', gitdir)
+
+        set_old_mtime()
+        git('add', 'a.txt')
+        check('staged', gitdir)
+
+        git('commit', '--quiet', '-m', 'modify')
+        os.unlink(os.path.join(root, 'b.txt'))
+        check('deleted', gitdir, False)
+
+        git('checkout', '--quiet', 'b.txt')
+        set_old_mtime()
+        git('update-index', '--refresh')
+        git('gc', '--quiet')
+        check('after gc', gitdir, True)
+
+        git('checkout', '--quiet', '--detach')
+        check('detached HEAD', gitdir, True)
+    return errors
+
+
+class _PackIndexOids:
+    # Sequence of the object identifiers of a pack index, for bisect
+    def __init__(self, idx, pos):
+        self.idx = idx
+        self.pos = pos
+
+    def __getitem__(self, index):
+        pos = self.pos + index * GIT_OID_SIZE
+        return self.idx[pos:pos + GIT_OID_SIZE]
+
+
+class TrackedFiles:
+    """
+    Sorted list of the paths of tracked files, relative to the repository
+    root and using "/" separator.
+
+    >>> files = TrackedFiles(['setup.py', 'doc/index.rst', 'doc/api/io.rst'])
+    >>> list(files)
+    ['doc/api/io.rst', 'doc/index.rst', 'setup.py']
+    >>> 'doc/index.rst' in files, 'doc' in files
+    (True, False)
+    >>> files.has_directory('doc/api'), files.has_directory('do')
+    (True, False)
+    >>> files.with_prefix('doc/')
+    ['doc/api/io.rst', 'doc/index.rst']
+    """
+    def __init__(self, files, is_sorted=False):
+        if not is_sorted:
+            files = sorted(files)
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __contains__(self, path):
+        index = bisect.bisect_left(self.files, path)
+        return index < len(self.files) and self.files[index] == path
+
+    def with_prefix(self, prefix):
+        """
+        Return the list of paths starting with prefix.
+        """
+        start = bisect.bisect_left(self.files, prefix)
+        # '\U0010ffff' is the greatest character
+        end = bisect.bisect_left(self.files, prefix + '\U0010ffff', start)
+        return self.files[start:end]
+
+    def has_directory(self, path):
+        """
+        Return True if the directory path contains at least one tracked file.
+        """
+        prefix = path + '/'
+        index = bisect.bisect_left(self.files, prefix)
+        return index < len(self.files) and self.files[index].startswith(prefix)
+
+    def encode(self):
+        r"""
+        Encode paths as "<shared prefix length>\t<suffix>" lines: a path
+        often shares its directory with the previous path.
+
+        >>> TrackedFiles(['doc/api.rst', 'doc/index.rst', 'setup.py']).encode()
+        '0\tdoc/api.rst\n4\tindex.rst\n0\tsetup.py\n'
+        """
+        lines = []
+        previous = ''
+        for path in self.files:
+            shared = len(os.path.commonprefix((previous, path)))
+            lines.append('%s\t%s\n' % (shared, path[shared:]))
+            previous = path
+        return ''.join(lines)
+
+    @classmethod
+    def decode(cls, data):
+        r"""
+        >>> list(TrackedFiles.decode('0\tdoc/api.rst\n4\tindex.rst\n'))
+        ['doc/api.rst', 'doc/index.rst']
+        """
+        files = []
+        path = ''
+        # Don't use splitlines(): paths can contain "\x1c" or "\u2028"
+        for line in data.split('\n')[:-1]:
+            shared, _, suffix = line.partition('\t')
+            path = path[:int(shared)] + suffix
+            files.append(path)
+        return cls(files, is_sorted=True)
+
+    @classmethod
+    def load(cls, filename, key):
+        """
+        Load the cache file: return None if it doesn't exist or if it was
+        written for a different key.
+        """
+        try:
+            with open(filename, encoding='utf-8', errors='surrogateescape') as fp:
+                data = fp.read()
+        except OSError:
+            return None
+        header = '%s\n%s\n' % (TRACKED_FILES_MAGIC, key)
+        if not data.startswith(header):
+            return None
+        return cls.decode(data[len(header):])
+
+    def save(self, filename, key):
+        """
+        Write the cache file atomically.
+        """
+        dirname, basename = os.path.split(filename)
+        fd, tmp_filename = tempfile.mkstemp(prefix=basename + '.', dir=dirname)
+        try:
+            with open(fd, 'w', encoding='utf-8', errors='surrogateescape') as fp:
+                fp.write('%s\n%s\n' % (TRACKED_FILES_MAGIC, key))
+                fp.write(self.encode())
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
+
 class Repository:
     SCM = None
+    # Options of scm_config lines, used by clone()
+    CLONE_OPTIONS = frozenset()
 
     def __init__(self, application, directory, url=None):
         self.application = application
         self._url = url
+        self.clone_options = {}
         # directory is relative to application.root
         self.root = os.path.realpath(os.path.join(self.application.root, directory))
         if self.root != self.application.start_directory:
@@ -743,10 +2139,7 @@ class Repository:
             cwd = kw.pop('cwd')
         else:
             cwd = self.root
-        env = os.environ.copy()
-        for name in ('LC_ALL', 'LC_CTYPE', 'LANG'):
-            if name in env:
-                del env[name]
+        env = get_subprocess_env()
         try:
             sys.stdout.flush()
             sys.stderr.flush()
@@ -795,19 +2188,15 @@ class Repository:
             raise ValueError("set_exitcode and ignore_exitcode cannot be used together")
 
         title = format_shell_args(cmd) + suffix
-        popen_args = {
-            'stdin': stdin,
-            'stdout': stdout,
-            'cwd': cwd,
-            'env': env,
-        }
         if verbose:
             self.print_text(title)
         elif not quiet:
             self.info_text(title)
         sys.stdout.flush()
         sys.stderr.flush()
-        exitcode = subprocess.call(cmd, **popen_args)
+        exitcode = self._call(cmd, stdin, stdout, cwd, env)
+        # The command may have modified the repository
+        self.invalidate_cache()
         if set_exitcode:
             self.application.set_exitcode(exitcode)
         elif not ignore_exitcode:
@@ -817,6 +2206,45 @@ class Repository:
             print("")
         return exitcode
 
+    def _call(self, cmd, stdin, stdout, cwd, env):
+        buffer = get_output_buffer()
+        if buffer is not None:
+            # Output buffered by -j N: capture the command output, and don't
+            # let concurrent commands read the terminal
+            if stdin is None:
+                stdin = subprocess.DEVNULL
+            if stdout is None:
+                proc = subprocess.run(cmd,
+                                      stdin=stdin,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      cwd=cwd,
+                                      env=env,
+                                      universal_newlines=True)
+                buffer.write(proc.stdout)
+            else:
+                # stdout is redirected to a file: only capture stderr
+                proc = subprocess.run(cmd,
+                                      stdin=stdin,
+                                      stdout=stdout,
+                                      stderr=subprocess.PIPE,
+                                      cwd=cwd,
+                                      env=env,
+                                      universal_newlines=True)
+                buffer.write(proc.stderr)
+            return proc.returncode
+        return subprocess.call(cmd, stdin=stdin, stdout=stdout, cwd=cwd, env=env)
+
+    def invalidate_cache(self):
+        pass
+
+    def close(self):
+        """
+        Release resources: called when a command is done with the
+        repository. The repository can still be used after close().
+        """
+        pass
+
     @contextlib.contextmanager
     def revert_local_changes(self):
         """
@@ -859,19 +2287,14 @@ class Repository:
     def distclean(self, remove):
         self.clean()
 
-        tracked_files = self._get_existing_files()
-        tracked_files = [os.path.join(self.root, filename) for filename in tracked_files]
-        dirs = set()
-        for filename in tracked_files:
-            dirname = filename
-            while True:
-                dirname = os.path.dirname(dirname)
-                if dirname == self.root:
-                    break
-                dirs.add(dirname)
-        tracked_files = set(tracked_files) | dirs
-        tracked_files.add(os.path.join(self.root, '.git'))
-        tracked_files.add(os.path.join(self.root, '.hg'))
+        tracked_files = self.get_tracked_files()
+
+        def is_tracked(name):
+            # A tracked file can be listed in dirnames: symbolic link to a
+            # directory, submodule. The .git entry of a worktree is a file.
+            return (name in DISTCLEAN_EXCLUDED_DIRS
+                    or name in tracked_files
+                    or tracked_files.has_directory(name))
 
         noop = True
         for dirpath, dirnames, filenames in os.walk(self.root):
@@ -881,20 +2304,30 @@ class Repository:
                 except ValueError:
                     pass
 
+            relpath = os.path.relpath(dirpath, self.root)
+            if relpath == os.curdir:
+                prefix = ''
+            else:
+                prefix = relpath.replace(os.sep, '/') + '/'
             for name in filenames:
+                if is_tracked(prefix + name):
+                    continue
                 fullname = os.path.join(dirpath, name)
-                if fullname not in tracked_files:
-                    print("Remove file %s" % fullname)
-                    if remove:
-                        os.unlink(fullname)
-                    noop = False
+                print("Remove file %s" % fullname)
+                if remove:
+                    os.unlink(fullname)
+                noop = False
             for name in dirnames:
+                if is_tracked(prefix + name):
+                    continue
                 fullname = os.path.join(dirpath, name)
-                if fullname not in tracked_files:
-                    print("Remove directory %s" % fullname)
-                    if remove:
+                print("Remove directory %s" % fullname)
+                if remove:
+                    if os.path.islink(fullname):
+                        os.unlink(fullname)
+                    else:
                         shutil.rmtree(fullname)
-                    noop = False
+                noop = False
         if not remove and not noop:
             print("")
             print("Now pass the --remove option to really remove files")
@@ -1007,12 +2440,31 @@ class Repository:
             print("WARNING: The repository doesn't track any file in the current directory.")
             return False
 
-        cmd = GREP + args + ('--',) + tuple(files)
         if prefix is not None:
-            exitcode, output = self.get_status_output(cmd, cwd=None)
+            # Filenames are relative to the current directory
+            directory = os.getcwd()
         else:
-            exitcode, output = self.get_status_output(cmd)
-        found = (exitcode == 0)
+            directory = self.root
+        output = None
+        if USE_GREP_ENGINE:
+            try:
+                regex = parse_grep_args(args)
+            except UnsupportedGrepOptions as err:
+                if self.application.verbose:
+                    print("WARNING: use %s: %s" % (GREP_PROGRAM, err), file=sys.stderr)
+            else:
+                lines, found = grep_files(regex, directory, files, COLORS == "always")
+                output = '\n'.join(lines)
+        if output is None:
+            # Pass files in batches to not exceed the command line length
+            found = False
+            outputs = []
+            for start in range(0, len(files), GREP_MAX_FILES):
+                cmd = GREP + args + ('--',) + tuple(files[start:start + GREP_MAX_FILES])
+                exitcode, batch_output = self.get_status_output(cmd, cwd=directory)
+                found |= (exitcode == 0)
+                outputs.append(batch_output.rstrip('\n'))
+            output = '\n'.join(filter(None, outputs))
         if (not output) and (not display_if_empty):
             return found
 
@@ -1095,12 +2547,25 @@ class Repository:
     def pull(self):
         raise NotImplementedError()
 
+    def get_shared_cache(self):
+        """
+        Return the path of the shared object cache, or None.
+        """
+        return None
+
+    def get_reference(self):
+        """
+        Return the path of the repository used by "clone --reference",
+        or None.
+        """
+        return None
+
     def get_existing_files(self):
         """
         Return (files, prefix) where files is the list of all files that exist
         on disk (e.g. ignore removed files).
         """
-        files = self._get_existing_files()
+        files = self.get_tracked_files()
         if (self.application.start_directory != self.root
            and not self.root.startswith(self.application.start_directory)):
             prefix = os.path.relpath(self.application.start_directory, self.root)
@@ -1109,15 +2574,134 @@ class Repository:
             prefix_len = len(prefix)
             files = [
                 filename[prefix_len:]
-                for filename in files
-                if filename.startswith(prefix)]
+                for filename in files.with_prefix(prefix.replace(os.sep, '/'))]
         else:
             prefix = None
+            files = list(files)
         return files, prefix
 
-    def _get_existing_files(self):
+    def get_tracked_files(self):
+        """
+        Get the TrackedFiles of the repository.
+
+        The list is cached in the SCM directory; the cache is used until
+        _get_tracked_files_key() changes.
+        """
+        if not USE_TRACKED_FILES_CACHE:
+            return TrackedFiles(self._list_tracked_files())
+        filename = os.path.join(self._get_scm_directory(), TRACKED_FILES_CACHE)
+        try:
+            key = self._get_tracked_files_key()
+        except OSError:
+            key = None
+        if key is not None:
+            files = TrackedFiles.load(filename, key)
+            if files is not None:
+                return files
+
+        files = TrackedFiles(self._list_tracked_files())
+        # Don't write the cache if the key changed while listing files
+        if key is not None and key == self._get_tracked_files_key():
+            try:
+                files.save(filename, key)
+            except OSError as err:
+                if self.application.verbose:
+                    print("WARNING: Fail to write %s: %s" % (filename, err),
+                          file=sys.stderr)
+        return files
+
+    def _get_scm_directory(self):
+        raise NotImplementedError()
+
+    def _get_tracked_files_key(self):
+        """
+        Return a string which changes when the list of tracked files changes,
+        or None to disable the cache.
+        """
         raise NotImplementedError()
 
+    def _list_tracked_files(self):
+        raise NotImplementedError()
+
+
+class HgCommandServerError(Exception):
+    pass
+
+
+class HgCommandServer:
+    """
+    Client of the Mercurial command server protocol: run hg commands in a
+    single "hg serve --cmdserver pipe" process.
+    """
+    def __init__(self, root):
+        self.process = subprocess.Popen(HG_CMDSERVER,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        cwd=root,
+                                        env=get_subprocess_env())
+        try:
+            channel, hello = self._read_channel()
+            fields = dict(line.split(b': ', 1) for line in hello.splitlines())
+            if channel != b'o' or b'runcommand' not in fields.get(b'capabilities', b'').split():
+                raise HgCommandServerError("unsupported command server: %r" % hello)
+            self.encoding = fields.get(b'encoding', b'ascii').decode('ascii')
+        except BaseException:
+            self.close()
+            raise
+
+    def _read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size:
+            raise HgCommandServerError("command server closed the pipe")
+        return data
+
+    def _read_channel(self):
+        channel, length = struct.unpack('>cI', self._read(5))
+        if channel in (b'I', b'L'):
+            # Input request: length is the maximum size to read
+            return channel, length
+        return channel, self._read(length)
+
+    def _write(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def runcommand(self, args):
+        """
+        Run an hg command: return (exitcode, stdout, stderr), stdout and
+        stderr are bytes.
+        """
+        data = b'\0'.join(arg.encode(self.encoding) for arg in args)
+        self._write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+        stdout = []
+        stderr = []
+        while True:
+            channel, data = self._read_channel()
+            if channel == b'o':
+                stdout.append(data)
+            elif channel == b'e':
+                stderr.append(data)
+            elif channel == b'r':
+                exitcode = struct.unpack('>i', data)[0]
+                return exitcode, b''.join(stdout), b''.join(stderr)
+            elif channel in (b'I', b'L'):
+                # No input available
+                self._write(struct.pack('>I', 0))
+            elif channel.isupper():
+                raise HgCommandServerError("unsupported required channel: %r" % channel)
+            # else: ignore optional channels (ex: debug)
+
+    def decode(self, data):
+        return data.decode(self.encoding, 'replace').replace('\r\n', '\n')
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
 
 class RepositoryHG(Repository):
     SCM = 'hg'
@@ -1125,6 +2709,45 @@ class RepositoryHG(Repository):
     def __init__(self, application, directory, url=None):
         Repository.__init__(self, application, directory, url)
         self.stash_file = os.path.join(self.root, '.hg', STASH_FILENAME)
+        # None: not started yet, False: unavailable
+        self._cmdserver = None
+
+    def _run_cmdserver(self, cmd, cwd):
+        """
+        Run an hg command in the command server: return (exitcode, stdout,
+        stderr), or None if the command must be run in a new process.
+        """
+        if not USE_HG_CMDSERVER or self._cmdserver is False:
+            return None
+        if (cmd[0] != HG_PROGRAM or len(cmd) < 2
+           or cmd[1] not in HG_CMDSERVER_COMMANDS or cwd != self.root):
+            return None
+        try:
+            if self._cmdserver is None:
+                self._cmdserver = HgCommandServer(self.root)
+            return self._cmdserver.runcommand(cmd[1:])
+        except (OSError, ValueError, HgCommandServerError) as err:
+            if self.application.verbose:
+                print("WARNING: Mercurial command server unavailable: %s" % err,
+                      file=sys.stderr)
+            if self._cmdserver:
+                self._cmdserver.close()
+            self._cmdserver = False
+            return None
+
+    def get_status_output(self, cmd, stderr=None, **kw):
+        result = self._run_cmdserver(cmd, kw.get('cwd', self.root))
+        if result is None:
+            return Repository.get_status_output(self, cmd, stderr=stderr, **kw)
+        exitcode, stdout, stderr_data = result
+        if stderr != 'null':
+            stdout += stderr_data
+        return exitcode, self._cmdserver.decode(stdout)
+
+    def close(self):
+        if self._cmdserver:
+            self._cmdserver.close()
+            self._cmdserver = None
 
     @classmethod
     def parse(cls, application, directory):
@@ -1349,8 +2972,24 @@ class RepositoryHG(Repository):
         self.run(HG_PUSH, verbose=False)
         print("")
 
-    def _get_existing_files(self):
-        cmd = HG_STATUS + ('--no-status', '--clean', '--modified', '--added')
+    def get_tracked_files(self):
+        # The dirstate doesn't change when a tracked file is deleted
+        # without "hg remove"
+        files = Repository.get_tracked_files(self)
+        root = os.fsencode(self.root)
+        return TrackedFiles([path for path in files
+                             if os.path.lexists(os.path.join(root, os.fsencode(path)))],
+                            is_sorted=True)
+
+    def _get_scm_directory(self):
+        return os.path.join(self.root, '.hg')
+
+    def _get_tracked_files_key(self):
+        with open(os.path.join(self.root, '.hg', 'dirstate'), 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+
+    def _list_tracked_files(self):
+        cmd = HG_STATUS + ('--no-status', '--clean', '--modified', '--added', '--deleted')
         output = self.get_output(cmd)
         output = output.strip()
         return output.splitlines()
@@ -1358,12 +2997,45 @@ class RepositoryHG(Repository):
 
 class RepositoryGIT(Repository):
     SCM = 'git'
+    CLONE_OPTIONS = frozenset(('depth', 'filter', 'reference', 'shared'))
 
     def __init__(self, application, directory, url=None, gitdir=None):
         Repository.__init__(self, application, directory, url)
         if gitdir is None:
             gitdir = os.path.join(self.root, '.git')
         self.gitdir = gitdir
+        self._status = None
+        self._reader = None
+
+    def get_status(self):
+        """
+        Get the GitStatus of the repository: run "git status" once and cache
+        the result until a command modifies the repository.
+        """
+        if self._status is None:
+            output = self.get_output(self._gitcmd(GIT_STATUS_SNAPSHOT))
+            self._status = GitStatus.parse(output)
+        return self._status
+
+    def invalidate_cache(self):
+        self._status = None
+        self._reader = None
+
+    def _read(self, method, *args):
+        """
+        Call a GitReader method: return None if git must be used instead.
+        """
+        if not USE_GIT_READER:
+            return None
+        try:
+            if self._reader is None:
+                self._reader = GitReader(self.gitdir)
+            return getattr(self._reader, method)(*args)
+        except (OSError, ValueError, struct.error, zlib.error, UnsupportedGitRepository) as err:
+            if self.application.verbose:
+                print("WARNING: %s: use git, %s() failed: %s" % (self, method, err),
+                      file=sys.stderr)
+            return None
 
     def _get_url(self):
         gitconfig = os.path.join(self.gitdir, 'config')
@@ -1409,27 +3081,26 @@ class RepositoryGIT(Repository):
         self.run(self._gitcmd(GIT_LIST_TAGS))
 
     def has_local_changes(self):
-        exitcode, stdout = self.get_status_output(self._gitcmd(GIT_STATUS_PORCELAIN))
-        for line in stdout.splitlines():
-            if line.startswith("?"):
-                continue
-            return True
-        return False
+        if self._status is None and self._read('is_clean', self.root):
+            return False
+        return bool(self.get_status().changes)
 
     def get_branch(self):
-        stdout = self.get_output(self._gitcmd(GIT_GET_BRANCH))
-        branch = None
-        for line in stdout.splitlines():
-            if line.startswith('* '):
-                branch = line[2:]
-                break
+        if self._status is None:
+            branch = self._read('get_branch')
+            if branch:
+                return branch
+        branch = self.get_status().branch
         if not branch:
-            raise Exception("Unable to find the branch in %r" % stdout)
+            raise Exception("Unable to find the branch of %s" % self)
         return branch
 
     def _info(self):
-        branch = self.get_branch()
-        print("branch = %s" % branch)
+        print("branch = %s" % self.get_branch())
+        status = self.get_status()
+        if status.upstream:
+            print("upstream = %s (ahead %s, behind %s)"
+                  % (status.upstream, status.ahead, status.behind))
 
     def add(self, args):
         self.run(self._gitcmd(GIT_ADD + args), verbose=False)
@@ -1461,7 +3132,7 @@ class RepositoryGIT(Repository):
             exitcode, stdout = self.get_status_output(args)
         else:
             args = self._gitcmd(GIT_STATUS_PORCELAIN)
-            exitcode, stdout = self.get_status_output(args)
+            stdout = self.get_status().format_porcelain()
         if not self.application.verbose:
             # filter files
             lines = []
@@ -1487,7 +3158,67 @@ class RepositoryGIT(Repository):
 
     def clone(self):
         url = self.get_url()
-        self.run(GIT_CLONE + (url, self.root), cwd=None)
+        cmd = GIT_CLONE
+        options = self.clone_options
+        if 'depth' in options:
+            cmd += ('--depth', options['depth'])
+        if 'filter' in options:
+            cmd += ('--filter=%s' % options['filter'],)
+        if 'reference' in options and 'shared' in options:
+            print("%s: reference and shared options are exclusive" % self)
+            sys.exit(1)
+        reference = self.get_reference()
+        if reference is not None:
+            cmd += ('--reference', reference)
+        shared = self.get_shared_cache()
+        if shared is not None and os.path.exists(shared):
+            cmd += ('--reference', shared)
+        self.run(cmd + (url, self.root), cwd=None)
+
+    def get_reference(self):
+        path = self.clone_options.get('reference')
+        if path is None:
+            return None
+        # The path is relative to the scm_config directory
+        return os.path.realpath(os.path.join(self.application.root, path))
+
+    def get_shared_cache(self):
+        path = self.clone_options.get('shared')
+        if path is None:
+            return None
+        return os.path.realpath(os.path.join(self.application.root, path))
+
+    def update_shared_cache(self, urls):
+        """
+        Create the shared object cache, a bare repository, if needed and
+        fetch urls into it: one remote per URL.
+        """
+        if not os.path.exists(self.gitdir):
+            self.run((GIT_PROGRAM, 'init', '--bare', '--quiet', self.gitdir),
+                     cwd=None, verbose=False)
+            # Clones use objects of the cache without referencing them:
+            # never prune unreachable objects
+            self.run(self._gitcmd(('config', 'gc.pruneExpire', 'never')),
+                     verbose=False)
+        for url in urls:
+            name = get_remote_name(url)
+            # Different URLs can get the same name, ex: "host/a_b/c" and
+            # "host/a/b_c": add a hash of the URL on conflict
+            url_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]
+            for name in (name, '%s_%s' % (name, url_hash)):
+                exitcode, stdout = self.get_status_output(
+                    self._gitcmd(('config', 'remote.%s.url' % name)))
+                if exitcode or stdout.strip() == url:
+                    break
+            else:
+                print("Failed to find a remote name for %s in %s" % (url, self))
+                sys.exit(1)
+            if exitcode:
+                self.run(self._gitcmd(('remote', 'add', name, url)), verbose=False)
+                # Forks can have different tags with the same name
+                self.run(self._gitcmd(('config', 'remote.%s.tagOpt' % name, '--no-tags')),
+                         verbose=False)
+        self.run(self._gitcmd(('fetch', '--all')))
 
     def _pull(self):
         pull = self._gitcmd(GIT_PULL)
@@ -1513,6 +3244,7 @@ class RepositoryGIT(Repository):
         else:
             self.info_text(text)
         stdout = self.get_output(self._gitcmd(GIT_STASH))
+        self.invalidate_cache()
         if verbose:
             self.write_output(self._gitcmd(GIT_STASH), stdout)
         return ("No local changes to save" not in stdout)
@@ -1551,28 +3283,10 @@ class RepositoryGIT(Repository):
         print("")
 
     def get_modified_files(self):
-        filenames = []
-        exitcode, stdout = self.get_status_output(self._gitcmd(GIT_STATUS_PORCELAIN))
-        if 'working directory clean' in stdout:
-            return filenames
-        for line in stdout.splitlines():
-            if line.startswith("?"):
-                continue
-            filename = line[3:]
-            filenames.append(filename)
-        return filenames
+        return self.get_status().get_modified_files()
 
     def get_untracked_files(self):
-        filenames = []
-        exitcode, stdout = self.get_status_output(self._gitcmd(GIT_STATUS_PORCELAIN))
-        if 'working directory clean' in stdout:
-            return filenames
-        for line in stdout.splitlines():
-            if not line.startswith("?"):
-                continue
-            filename = line[3:]
-            filenames.append(filename)
-        return filenames
+        return list(self.get_status().untracked)
 
     def revert(self, args):
         if not args:
@@ -1589,7 +3303,18 @@ class RepositoryGIT(Repository):
         else:
             return (GIT_PROGRAM,) + cmd
 
-    def _get_existing_files(self):
+    def _get_scm_directory(self):
+        return self.gitdir
+
+    def _get_tracked_files_key(self):
+        # Git writes a new index file and renames it
+        st = os.stat(os.path.join(self.gitdir, 'index'))
+        return '%s-%s-%s' % (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _list_tracked_files(self):
+        files = self._read('list_files')
+        if files is not None:
+            return files
         output = self.get_output(self._gitcmd(GIT_LIST_FILES))
         output = output.strip()
         return output.splitlines()
@@ -1599,7 +3324,7 @@ SCM_CLASSES = dict((klass.SCM, klass) for klass in (RepositoryHG, RepositoryGIT)
 
 
 def usage():
-    print("usage: %s command" % sys.argv[0])
+    print("usage: %s [-v] [-j N] command" % sys.argv[0])
     print("")
     print("Available commands:")
     for commands in ALL_COMMANDS:
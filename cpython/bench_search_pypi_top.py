@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+"""
+Benchmark search_pypi_top.py on a synthetic corpus.
+
+Usage::
+
+    ./bench_search_pypi_top.py [--archives N] [--members N] [--lines N]
+
+Compare the line by line scan (--scan=lines) to the whole buffer scan
+(--scan=buffer), and the whole buffer scan without and with the literal
+prefilter. First check that both scans find the same lines for regexes
+using anchors and lookaround assertions.
+"""
+import argparse
+import io
+import os.path
+import random
+import re
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import search_pypi_top  # noqa
+
+
+PATTERN = rb'PyUnicode_AS_UNICODE'
+# Probability that a member contains the searched symbol
+MATCHING_MEMBER_PROBABILITY = 0.1
+# Probability that a line of a matching member contains the searched symbol
+MATCH_PROBABILITY = 0.005
+C_LINES = (
+    b"    PyObject *res = PyObject_CallNoArgs(func);",
+    b"    if (res == NULL) {",
+    b"        return NULL;",
+    b"    }",
+    b"    Py_DECREF(res);",
+    b"static int",
+    b"module_exec(PyObject *module)",
+    b"{",
+    b"}",
+    b"    /* comment */",
+    b"",
+)
+MATCH_LINE = b"    Py_UNICODE *str = PyUnicode_AS_UNICODE(obj);"
+# Regexes which must give the same matches with --scan=lines and
+# --scan=buffer
+EQUIVALENCE_PATTERNS = (
+    PATTERN,
+    rb'^    Py_DECREF',
+    rb'\A    Py',
+    rb'NULL;\n\Z',
+    rb'(?<!\n)module_exec',
+    rb'\{\n(?!\s)',
+)
+
+
+def create_member(rng, nline):
+    matching = (rng.random() < MATCHING_MEMBER_PROBABILITY)
+    lines = []
+    for _ in range(nline):
+        if matching and rng.random() < MATCH_PROBABILITY:
+            lines.append(MATCH_LINE)
+        else:
+            lines.append(rng.choice(C_LINES))
+    lines.append(b"")
+    return b"\n".join(lines)
+
+
+def create_corpus(directory, args):
+    rng = random.Random(args.seed)
+    members = []
+    for archive in range(args.archives):
+        name = f"project{archive}-1.0"
+        filename = os.path.join(directory, f"{name}.tar.gz")
+        with tarfile.open(filename, "w:gz") as tar:
+            for member in range(args.members):
+                data = create_member(rng, args.lines)
+                members.append(data)
+                info = tarfile.TarInfo(f"{name}/src/file{member}.c")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return members
+
+
+def bench(func, loops):
+    best = None
+    for _ in range(loops):
+        start_time = time.perf_counter()
+        result = func()
+        dt = time.perf_counter() - start_time
+        if best is None or dt < best:
+            best = dt
+    return best, result
+
+
+def bench_scan(members, regex, loops):
+    buffer_regex = re.compile(regex.pattern, regex.flags | re.MULTILINE)
+
+    def scan_lines():
+        return sum(len(search_pypi_top.scan_lines(io.BytesIO(data), regex))
+                   for data in members)
+
+    def scan_buffer():
+        return sum(len(search_pypi_top.scan_buffer(data, regex, buffer_regex))
+                   for data in members)
+
+    return (("scan_lines()", bench(scan_lines, loops)),
+            ("scan_buffer()", bench(scan_buffer, loops)))
+
+
+def bench_prefilter(members, regex, loops):
+    buffer_regex = re.compile(regex.pattern, regex.flags | re.MULTILINE)
+    prefilter = search_pypi_top.get_prefilter([regex])
+
+    def scan_buffer():
+        return sum(len(search_pypi_top.scan_buffer(data, regex, buffer_regex))
+                   for data in members)
+
+    def scan_prefilter():
+        return sum(len(search_pypi_top.scan_buffer(data, regex, buffer_regex))
+                   for data in members
+                   if search_pypi_top.match_prefilter(prefilter, data))
+
+    return (("scan_buffer()", bench(scan_buffer, loops)),
+            ("prefilter + scan_buffer()", bench(scan_prefilter, loops)))
+
+
+def bench_grep(directory, regex, loops):
+    filenames = [os.path.join(directory, filename)
+                 for filename in search_pypi_top.list_archives(directory)]
+
+    results = []
+    for scan in ("lines", "buffer"):
+        args = argparse.Namespace(text=False, scan=scan, cache=None)
+
+        def grep():
+            return sum(1 for filename in filenames
+                       for match in search_pypi_top.grep(args, filename, regex))
+
+        results.append((f"grep --scan={scan}", bench(grep, loops)))
+
+    args = argparse.Namespace(text=False, scan="buffer", cache=None)
+    prefilter = search_pypi_top.get_prefilter([regex])
+
+    def grep_prefilter():
+        return sum(1 for filename in filenames
+                   for match in search_pypi_top.grep(args, filename, regex,
+                                                     prefilter=prefilter))
+
+    results.append(("grep --scan=buffer + prefilter", bench(grep_prefilter, loops)))
+    return results
+
+
+def check_scan_equivalence(directory):
+    filenames = [os.path.join(directory, filename)
+                 for filename in search_pypi_top.list_archives(directory)]
+    for pattern in EQUIVALENCE_PATTERNS:
+        regex = re.compile(pattern)
+        results = []
+        for scan in ("lines", "buffer"):
+            args = argparse.Namespace(text=False, scan=scan, cache=None)
+            results.append([(filename, match) for filename in filenames
+                            for match in search_pypi_top.grep(args, filename, regex)])
+        if results[0] != results[1]:
+            print(f"ERROR: {pattern!r}: --scan=buffer found {len(results[1])} lines, "
+                  f"--scan=lines found {len(results[0])} lines")
+            sys.exit(1)
+    print(f"Scan equivalence: {len(EQUIVALENCE_PATTERNS)} regexes OK")
+    print()
+
+
+def display(title, results):
+    print(title)
+    ref_dt, ref_count = results[0][1]
+    for name, (dt, count) in results:
+        if count != ref_count:
+            print(f"ERROR: {name} found {count} lines, expected {ref_count}")
+            sys.exit(1)
+        print(f"- {name}: {dt * 1e3:.1f} ms ({ref_dt / dt:.2f}x)")
+    print(f"Matching lines: {ref_count}")
+    print()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark search_pypi_top.py.')
+    parser.add_argument('--archives', metavar='N', type=int, default=20,
+                        help='Number of archives (default: %(default)s)')
+    parser.add_argument('--members', metavar='N', type=int, default=50,
+                        help='Number of members per archive (default: %(default)s)')
+    parser.add_argument('--lines', metavar='N', type=int, default=2000,
+                        help='Number of lines per member (default: %(default)s)')
+    parser.add_argument('--loops', metavar='N', type=int, default=3,
+                        help='Number of loops, keep the best timing (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed (default: %(default)s)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    regex = re.compile(PATTERN)
+    with tempfile.TemporaryDirectory() as directory:
+        members = create_corpus(directory, args)
+        size = sum(map(len, members))
+        print(f"Corpus: {args.archives} archives, {len(members)} members, "
+              f"{size / 1024 ** 2:.1f} MiB")
+        print()
+
+        check_scan_equivalence(directory)
+        display("Scan decompressed members:", bench_scan(members, regex, args.loops))
+        display("Literal prefilter:", bench_prefilter(members, regex, args.loops))
+        display("Grep archives:", bench_grep(directory, regex, args.loops))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,15 +16,68 @@
 #
 # Try:
 # https://hugovk.github.io/top-pypi-packages/top-pypi-packages.min.json
+#
+# Dependencies: aiohttp, and optionally termcolor:
+#
+#     python -m pip install --user aiohttp termcolor
+#
+# Downloads use asyncio and aiohttp: connections are kept alive and pooled
+# per host, proxies are read from environment variables (HTTPS_PROXY, etc.).
+# Project metadata (PyPI JSON) and sdists are
+# fetched by two pipelined stages: sdists are downloaded while the metadata
+# of the next projects is fetched.
+#
+# sdists are streamed into a DIRECTORY/FILENAME.part temporary file which is
+# renamed once the download is complete and its SHA-256 digest checked. An
+# interrupted download is resumed with an HTTP Range request.
+#
+# With --sync, DIRECTORY/.manifest.json records the downloaded sdist of each
+# project (version, filename, SHA-256, size and ETag of the PyPI JSON). Only
+# new and updated sdists are downloaded, sdists of old versions and of
+# projects which left the top list are removed, and the PyPI JSON of known
+# projects is requested with If-None-Match.
+#
+# JSON metadata (top list and PyPI JSON) is cached on disk, in
+# ~/.cache/download_pypi_top/ by default: entries younger than --cache-ttl are
+# used without any request, older entries are revalidated with If-None-Match.
+# Entries are written atomically, so the cache can be shared by concurrent
+# runs, and the oldest entries are removed above --cache-size.
+#
+# The number of concurrent requests per host is adaptive (AIMD): it starts at
+# INITIAL_JOBS, is increased while requests succeed with a stable latency, and
+# is halved on HTTP 429 and 5xx errors and connection errors, up to --jobs.
+# Failed requests are retried with a jittered exponential backoff.
+#
+# With --grep REGEX, sdists are searched by search_pypi_top.py worker
+# processes as soon as they are downloaded, while the next sdists are being
+# downloaded.
+#
+# Use --top-url and --index-url to use a local HTTP server instead of PyPI.
 
 import argparse
-import requests
-import traceback
+import asyncio
+import collections
+import contextlib
+import hashlib
 import json
 import os
+import random
+import re
+import statistics
 import sys
+import tempfile
 import time
-from concurrent.futures import ThreadPoolExecutor
+import traceback
+import urllib.parse
+
+import search_pypi_top
+
+
+try:
+    import aiohttp
+except ImportError:
+    print("Error: aiohttp is missing, install it with: python -m pip install --user aiohttp", file=sys.stderr)
+    sys.exit(1)
 
 
 try:
@@ -37,47 +90,752 @@ except ImportError:
         print(msg)
 
 
-session = requests.Session()
-
 JSON_URL = 'https://hugovk.github.io/top-pypi-packages/top-pypi-packages.min.json'
+INDEX_URL = 'https://pypi.org/pypi'
+USER_AGENT = 'download_pypi_top.py'
+CHUNK_SIZE = 64 * 1024
+PART_SUFFIX = '.part'
+MANIFEST_FILENAME = '.manifest.json'
+MANIFEST_VERSION = 1
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME')
+                         or os.path.expanduser('~/.cache'),
+                         'download_pypi_top')
+CACHE_VERSION = 1
+CACHE_TTL = 3600
+# in MiB
+CACHE_SIZE = 256
+MAX_REDIRECTS = 5
+INITIAL_JOBS = 4
+# Don't increase the concurrency if a request is LATENCY_FACTOR times slower
+# than the average latency
+LATENCY_FACTOR = 3.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+# in seconds
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+CONNECT_TIMEOUT = 30.0
+READ_TIMEOUT = 60.0
+# Errors while reading a response body: the download can be resumed
+BODY_ERRORS = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError,
+               asyncio.TimeoutError)
+
+
+def retry_delay(attempt, resp=None):
+    # Exponential backoff with "full jitter"
+    delay = random.uniform(0, min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY))
+    if resp is not None:
+        retry_after = resp.headers.get('retry-after', '')
+        if retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), RETRY_MAX_DELAY))
+    return delay
+
+
+class AdaptiveLimiter:
+    """
+    Limit the number of concurrent requests to a host.
+
+    AIMD (additive increase, multiplicative decrease): the limit grows by 1
+    after "limit" successful requests, and is halved on error, at most once
+    per average latency.
+    """
+    def __init__(self, initial, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(min(initial, max_limit))
+        self.active = 0
+        self._waiters = collections.deque()
+        self._latency = None
+        self._last_decrease = 0.0
+
+    async def acquire(self):
+        while self.active >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    # Pass the wake up to another waiter
+                    self._wake_up()
+                raise
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._wake_up()
+
+    def _wake_up(self):
+        free = int(self.limit) - self.active
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def success(self, latency):
+        if self._latency is None:
+            self._latency = latency
+        healthy = (latency <= self._latency * LATENCY_FACTOR)
+        self._latency = self._latency * 0.8 + latency * 0.2
+        # Only grow if the current limit is used
+        if healthy and self.active + 1 >= int(self.limit):
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self._wake_up()
+
+    def error(self):
+        now = time.monotonic()
+        if now - self._last_decrease < (self._latency or 0.0):
+            # Errors of requests sent before the previous decrease
+            return
+        self._last_decrease = now
+        self.limit = max(self.limit / 2, 1.0)
+
+
+class ConnectionPool:
+    """
+    aiohttp session with an adaptive limit of concurrent requests per host
+    (at most max_per_host).
+    """
+    def __init__(self, max_per_host, initial_per_host=INITIAL_JOBS):
+        self.max_per_host = max_per_host
+        self.initial_per_host = initial_per_host
+        self.retries = 0
+        self._limiters = {}
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=max_per_host)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT,
+                                        sock_read=READ_TIMEOUT)
+        # Accept-Encoding: identity, so Range offsets and sizes are offsets
+        # and sizes of the file
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={'User-Agent': USER_AGENT, 'Accept-Encoding': 'identity'},
+            auto_decompress=False,
+            trust_env=True)
 
+    def _limiter(self, host):
+        try:
+            return self._limiters[host]
+        except KeyError:
+            limiter = AdaptiveLimiter(self.initial_per_host, self.max_per_host)
+            self._limiters[host] = limiter
+            return limiter
+
+    def limits(self):
+        return {host: limiter.limit for host, limiter in self._limiters.items()}
+
+    @contextlib.asynccontextmanager
+    async def get(self, url, headers=None):
+        """
+        Send a GET request, follow redirections and retry on HTTP 429 and 5xx
+        errors and on connection errors: context manager which yields an
+        aiohttp response.
+        """
+        limiter = self._limiter(urllib.parse.urlsplit(url).hostname)
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            start_time = time.monotonic()
+            success = False
+            delay = None
+            try:
+                try:
+                    resp = await self._session.get(url, headers=headers,
+                                                   max_redirects=MAX_REDIRECTS)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                    if attempt >= MAX_RETRIES:
+                        limiter.error()
+                        raise
+                    cprint(f"Retry {url}: {exc!r}", "yellow")
+                    resp = None
+                if resp is None or (resp.status in RETRY_STATUS and attempt < MAX_RETRIES):
+                    limiter.error()
+                    delay = retry_delay(attempt, resp)
+                    if resp is not None:
+                        resp.release()
+                    attempt += 1
+                    self.retries += 1
+                else:
+                    if resp.status in RETRY_STATUS:
+                        limiter.error()
+                    try:
+                        yield resp
+                    finally:
+                        # Reuse the connection if the body was read
+                        resp.release()
+                    success = resp.status < 400
+                    return
+            finally:
+                limiter.release()
+                if success:
+                    limiter.success(time.monotonic() - start_time)
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        await self._session.close()
+
+
+class MetadataCache:
+    """
+    On-disk cache of JSON documents keyed by URL.
+
+    Each entry is a JSON file storing the URL, the ETag, the time of the last
+    validation and the document.
+    """
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _filename(self, url):
+        key = hashlib.sha256(url.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, url):
+        filename = self._filename(url)
+        try:
+            with open(filename, encoding="utf8") as fp:
+                entry = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+        if entry.get("version") != CACHE_VERSION or entry.get("url") != url:
+            return None
+        # Update the modification time for evict(). The validation time is
+        # stored in the entry.
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def is_fresh(self, entry):
+        return (time.time() - entry["time"] < self.ttl)
+
+    def set(self, url, etag, data):
+        entry = {"version": CACHE_VERSION, "url": url, "etag": etag,
+                 "time": time.time(), "data": data}
+        # Write a temporary file and rename it, so a concurrent run never
+        # reads a truncated entry
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with open(fd, "w", encoding="utf8") as fp:
+                json.dump(entry, fp)
+            os.replace(tmp_filename, self._filename(url))
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
 
-def projects():
-    cprint(f"Download JSON from: {JSON_URL}", "green")
-    resp = session.get(JSON_URL)
-    resp.raise_for_status()
-    top = json.loads(resp.content)
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache size is
+        smaller than max_size.
+
+        Temporary files of concurrent runs are ignored.
+        """
+        entries = []
+        size = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # Removed by a concurrent run
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            size += st.st_size
+        entries.sort()
+        for mtime, entry_size, filename in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(filename)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+
+class Stats:
+    def __init__(self):
+        self.metadata_time = 0.0
+        self.metadata_requests = 0
+        self.cache_hits = 0
+        self.cache_revalidated = 0
+        self.download_time = 0.0
+        self.download_latencies = []
+        self.retries = 0
+        self.limits = {}
+        self.downloads = 0
+        self.downloaded_bytes = 0
+        self.exists = 0
+        self.resumed = 0
+        self.unchanged = 0
+        self.pruned = 0
+        self.failed = 0
+
+    def display(self, nproject, dt):
+        cprint(f"Downloaded {nproject} projects in {dt:.1f} seconds "
+               f"({nproject / dt:.1f} projects/sec)", "green")
+        if self.metadata_requests:
+            cprint(f"Metadata: {self.metadata_requests} requests, "
+                   f"{self.metadata_time:.1f} sec "
+                   f"(mean: {self.metadata_time * 1e3 / self.metadata_requests:.0f} ms)",
+                   "green")
+        if self.cache_hits or self.cache_revalidated:
+            cprint(f"Metadata cache: {self.cache_hits} hits, "
+                   f"{self.cache_revalidated} revalidated", "green")
+        if self.downloads:
+            cprint(f"Download: {self.downloads} sdists, "
+                   f"{self.downloaded_bytes / 1024 ** 2:.1f} MiB, "
+                   f"{self.download_time:.1f} sec "
+                   f"(mean: {self.download_time * 1e3 / self.downloads:.0f} ms)",
+                   "green")
+            cprint(f"Throughput: {self.downloaded_bytes / 1024 ** 2 / dt:.1f} MiB/sec, "
+                   f"{self.downloads / dt:.1f} sdists/sec", "green")
+        if len(self.download_latencies) >= 2:
+            percentiles = statistics.quantiles(self.download_latencies, n=20)
+            cprint(f"Download latency: p50 {percentiles[9] * 1e3:.0f} ms, "
+                   f"p95 {percentiles[18] * 1e3:.0f} ms", "green")
+        for host, limit in sorted(self.limits.items()):
+            cprint(f"Concurrency limit of {host}: {int(limit)}", "green")
+        if self.retries:
+            cprint(f"Retries: {self.retries} requests", "yellow")
+        if self.resumed:
+            cprint(f"Resumed: {self.resumed} downloads", "yellow")
+        if self.exists:
+            cprint(f"Already downloaded: {self.exists} sdists", "yellow")
+        if self.unchanged:
+            cprint(f"Unchanged: {self.unchanged} projects", "green")
+        if self.pruned:
+            cprint(f"Removed: {self.pruned} old sdists", "yellow")
+        if self.failed:
+            cprint(f"Failed: {self.failed} projects", "red")
+
+
+async def get_json(pool, cache, stats, url, etag=None):
+    """
+    Get a JSON document using the cache: return (data, etag).
+
+    If etag is set and the document has the same ETag, data is None.
+    """
+    entry = cache.get(url) if cache is not None else None
+    if entry is not None and cache.is_fresh(entry):
+        stats.cache_hits += 1
+        data = entry["data"]
+        new_etag = entry["etag"]
+    else:
+        headers = {}
+        if entry is not None and entry["etag"]:
+            headers['If-None-Match'] = entry["etag"]
+        elif etag:
+            headers['If-None-Match'] = etag
+        start_time = time.monotonic()
+        async with pool.get(url, headers) as resp:
+            resp.raise_for_status()
+            if resp.status == 304:
+                await resp.read()
+                data = None
+            else:
+                data = json.loads(await resp.read())
+            new_etag = resp.headers.get('etag')
+        stats.metadata_time += time.monotonic() - start_time
+        stats.metadata_requests += 1
+
+        if data is None:
+            if entry is None:
+                # Not cached, but the caller already has this version
+                return None, etag
+            stats.cache_revalidated += 1
+            data = entry["data"]
+            new_etag = new_etag or entry["etag"]
+        if cache is not None:
+            cache.set(url, new_etag, data)
+
+    if etag and new_etag == etag:
+        return None, etag
+    return data, new_etag
+
+
+async def projects(pool, cache, args, stats):
+    cprint(f"Download JSON from: {args.top_url}", "green")
+    top, _ = await get_json(pool, cache, stats, args.top_url)
     return [p["project"] for p in top["rows"]]
 
 
-def find_url(proj):
-    resp = session.get(f"https://pypi.org/pypi/{proj}/json")
-    resp.raise_for_status()
-    data = resp.json()
+async def get_metadata(pool, cache, args, stats, proj, etag=None):
+    """
+    Get the PyPI JSON of a project: return (data, etag).
+
+    If etag is set, data is None if the metadata did not change.
+    """
+    return await get_json(pool, cache, stats, f"{args.index_url}/{proj}/json", etag)
+
+
+def find_sdist(data):
+    """
+    Get the PyPI JSON entry of the sdist of a project: dict with "url" and
+    "digests" keys. Return None if the project has no sdist.
+    """
     for entry in data["urls"]:
         if entry["packagetype"] == "sdist":
-            return entry["url"]
+            return entry
     return None
 
 
-def download_sdist(dst_dir, index, proj, nproject):
-    url = find_url(proj)
-    if not url:
-        # Universal wheel only, maybe.
-        cprint(f"Cannot find URL for project: {proj}", "red")
+def load_manifest(dst_dir):
+    filename = os.path.join(dst_dir, MANIFEST_FILENAME)
+    try:
+        with open(filename, encoding="utf8") as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        cprint(f"Ignore manifest with an unsupported version: {filename}", "yellow")
+        return {}
+    return manifest["projects"]
+
+
+def save_manifest(dst_dir, projects):
+    filename = os.path.join(dst_dir, MANIFEST_FILENAME)
+    tmp_filename = filename + '.tmp'
+    manifest = {"version": MANIFEST_VERSION, "projects": projects}
+    with open(tmp_filename, "w", encoding="utf8") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+def prune_sdist(stats, dst_dir, record):
+    filename = os.path.join(dst_dir, record["filename"])
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
         return
-    filename = url[url.rfind('/')+1:]
-    filename = os.path.join(dst_dir, filename)
+    cprint(f"Remove {filename}", "yellow")
+    stats.pruned += 1
+
+
+def hash_file(filename):
+    hasher = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        while True:
+            chunk = fp.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher
+
+
+def parse_content_range(value):
+    """
+    Get the first byte position of a Content-Range header.
+
+    >>> parse_content_range("bytes 100-199/200")
+    100
+    """
+    unit, _, byte_range = value.partition(' ')
+    start = byte_range.partition('-')[0]
+    if unit != 'bytes' or not start.isdigit():
+        return None
+    return int(start)
+
+
+async def download_sdist(pool, stats, dst_dir, index, proj, nproject, entry,
+                         verify=False):
+    """
+    Download an sdist: return its filename (relative to dst_dir).
+
+    If verify is true, an existing file is downloaded again if its SHA-256
+    digest is different.
+    """
+    url = entry["url"]
+    sha256 = entry.get("digests", {}).get("sha256")
+    expected_size = entry.get("size")
+    basename = url[url.rfind('/')+1:]
+    filename = os.path.join(dst_dir, basename)
+    loop = asyncio.get_running_loop()
     if os.path.exists(filename):
-        cprint(f"Exists: {filename}", "yellow")
-        return
-    resp = session.get(url)
-    resp.raise_for_status()
-    content = resp.content
-    cprint(f"[{index}/{nproject}] "
-           f"Saving to {filename} ({len(content) / 1024.:.1f} kB)", "green")
-    with open(filename, "wb") as f:
-        f.write(content)
+        if (not (verify and sha256)
+           or (await loop.run_in_executor(None, hash_file, filename)).hexdigest() == sha256):
+            cprint(f"Exists: {filename}", "yellow")
+            stats.exists += 1
+            return basename
+
+    part_filename = filename + PART_SUFFIX
+    try:
+        offset = os.path.getsize(part_filename)
+    except FileNotFoundError:
+        offset = 0
+    headers = {}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+
+    start_time = time.monotonic()
+    async with pool.get(url, headers) as resp:
+        if resp.status == 416:
+            # The part file is complete, or bigger than the sdist
+            await resp.read()
+            if sha256 and offset == expected_size:
+                hasher = await loop.run_in_executor(None, hash_file, part_filename)
+            else:
+                hasher = None
+            if hasher is None or hasher.hexdigest() != sha256:
+                # The part file cannot be verified, or is corrupted
+                cprint(f"Remove invalid partial download: {part_filename}", "yellow")
+                os.unlink(part_filename)
+                return await download_sdist(pool, stats, dst_dir, index, proj,
+                                            nproject, entry, verify)
+        else:
+            resp.raise_for_status()
+            if (offset and resp.status == 206
+               and parse_content_range(resp.headers.get('content-range', '')) == offset):
+                stats.resumed += 1
+                hasher = await loop.run_in_executor(None, hash_file, part_filename)
+                mode = "ab"
+            else:
+                # New download, or the server ignored the Range header
+                offset = 0
+                hasher = hashlib.sha256()
+                mode = "wb"
+            with open(part_filename, mode) as fp:
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    fp.write(chunk)
+                    hasher.update(chunk)
+    dt = time.monotonic() - start_time
+    stats.download_time += dt
+    stats.download_latencies.append(dt)
+
+    size = os.path.getsize(part_filename)
+    if expected_size is not None and size != expected_size:
+        os.unlink(part_filename)
+        raise ValueError(f"size mismatch: {url} ({size} bytes, expected {expected_size} bytes)")
+    if sha256 and hasher.hexdigest() != sha256:
+        os.unlink(part_filename)
+        raise ValueError(f"SHA-256 digest mismatch: {url}")
+    os.replace(part_filename, filename)
+    stats.downloads += 1
+    stats.downloaded_bytes += size - offset
+    text = f"[{index}/{nproject}] Saved {filename} ({size / 1024.:.1f} kB"
+    if offset:
+        text += f", resumed at {offset / 1024.:.1f} kB"
+    cprint(text + ")", "green")
+    return basename
+
+
+async def metadata_worker(pool, cache, args, stats, manifest, projects_queue,
+                          download_queue, search_queue):
+    while True:
+        item = await projects_queue.get()
+        if item is None:
+            break
+        index, proj = item
+        record = manifest.get(proj) if manifest is not None else None
+        if (record is not None
+           and not os.path.exists(os.path.join(args.dst_dir, record["filename"]))):
+            record = None
+        try:
+            etag = record["etag"] if record is not None else None
+            data, etag = await get_metadata(pool, cache, args, stats, proj, etag)
+        except Exception:
+            traceback.print_exc()
+            cprint(f"Failed to get metadata of {proj}", "red")
+            stats.failed += 1
+            continue
+        if data is None:
+            # HTTP 304: the metadata didn't change
+            stats.unchanged += 1
+            if search_queue is not None:
+                await search_queue.put((index, record["filename"]))
+            continue
+        entry = find_sdist(data)
+        if not entry:
+            # Universal wheel only, maybe.
+            cprint(f"Cannot find URL for project: {proj}", "red")
+            if manifest is not None and proj in manifest:
+                prune_sdist(stats, args.dst_dir, manifest.pop(proj))
+            continue
+        sha256 = entry.get("digests", {}).get("sha256")
+        if (record is not None and sha256 and record["sha256"] == sha256
+           and entry["url"].endswith('/' + record["filename"])):
+            # New metadata, but the sdist didn't change
+            record["etag"] = etag
+            stats.unchanged += 1
+            if search_queue is not None:
+                await search_queue.put((index, record["filename"]))
+            continue
+        await download_queue.put((index, proj, data["info"]["version"], etag, entry))
+
+
+async def download_worker(pool, args, stats, manifest, download_queue,
+                          search_queue, nproject):
+    while True:
+        item = await download_queue.get()
+        if item is None:
+            break
+        index, proj, version, etag, entry = item
+        attempt = 0
+        while True:
+            try:
+                filename = await download_sdist(pool, stats, args.dst_dir,
+                                                index, proj, nproject, entry,
+                                                verify=(manifest is not None))
+                break
+            except BODY_ERRORS as exc:
+                # Connection lost while reading the body: resume the download
+                if attempt >= MAX_RETRIES:
+                    filename = None
+                    traceback.print_exc()
+                    break
+                cprint(f"Retry download of {proj}: {exc!r}", "yellow")
+                pool.retries += 1
+                await asyncio.sleep(retry_delay(attempt))
+                attempt += 1
+            except Exception:
+                filename = None
+                traceback.print_exc()
+                break
+        if filename is None:
+            cprint(f"Failed to download {proj}", "red")
+            stats.failed += 1
+            continue
+        if search_queue is not None:
+            await search_queue.put((index, filename))
+        if manifest is None:
+            continue
+        old_record = manifest.get(proj)
+        manifest[proj] = {
+            "project": proj,
+            "version": version,
+            "filename": filename,
+            "sha256": entry.get("digests", {}).get("sha256"),
+            "size": os.path.getsize(os.path.join(args.dst_dir, filename)),
+            "etag": etag,
+        }
+        if old_record is not None and old_record["filename"] != filename:
+            prune_sdist(stats, args.dst_dir, old_record)
+
+
+async def search_worker(search, search_queue, nproject):
+    """
+    Submit downloaded sdists to the search worker processes. At most
+    search.args.window tasks are searched at the same time: when the window
+    is full, search_queue fills up and download workers wait.
+
+    An archive which cannot be searched is logged and ignored.
+    """
+    window = search.args.window
+    while True:
+        item = await search_queue.get()
+        if item is None:
+            break
+        index, filename = item
+        try:
+            tasks = list(search_pypi_top.schedule_tasks(search.pypi_dir, [filename]))
+        except Exception as exc:
+            cprint(f"Failed to search {filename}: {exc!r}", "red")
+            continue
+        for _, member_range in tasks:
+            while search.inflight >= window:
+                await wait_search_result(search)
+            search.submit(filename, member_range, index, nproject)
+    while search.inflight:
+        await wait_search_result(search)
+
+
+async def wait_search_result(search):
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, search.wait_result)
+    except Exception as exc:
+        cprint(f"Search failed: {exc!r}", "red")
+
+
+async def wait_all(tasks):
+    """
+    Wait until all tasks complete. If a task fails, cancel the other tasks
+    and raise its exception.
+    """
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+
+async def download_all(args, stats, search=None):
+    manifest = load_manifest(args.dst_dir) if args.sync else None
+    if args.cache_dir:
+        cache = MetadataCache(args.cache_dir, args.cache_ttl,
+                              args.cache_size * 1024 ** 2)
+    else:
+        cache = None
+    pool = ConnectionPool(max_per_host=args.jobs)
+    try:
+        projs = await projects(pool, cache, args, stats)
+        if args.count:
+            projs = projs[:args.count]
+        nproject = len(projs)
+        print(f"Project#: {nproject}")
+
+        if manifest is not None:
+            # Remove projects which are no longer in the top list
+            for proj in sorted(manifest.keys() - set(projs)):
+                prune_sdist(stats, args.dst_dir, manifest.pop(proj))
+
+        projects_queue = asyncio.Queue()
+        for item in enumerate(projs, start=1):
+            projects_queue.put_nowait(item)
+        # Bounded queue: don't fetch metadata too far ahead of downloads
+        download_queue = asyncio.Queue(2 * args.jobs)
+        if search is not None:
+            # Bounded queue: don't download too far ahead of the search
+            search_queue = asyncio.Queue(search.args.window)
+            search_task = asyncio.create_task(search_worker(search, search_queue, nproject))
+        else:
+            search_queue = None
+
+        metadata_workers = [
+            asyncio.create_task(metadata_worker(pool, cache, args, stats, manifest,
+                                                projects_queue, download_queue,
+                                                search_queue))
+            for _ in range(args.jobs)]
+        download_workers = [
+            asyncio.create_task(download_worker(pool, args, stats, manifest,
+                                                download_queue, search_queue,
+                                                nproject))
+            for _ in range(args.jobs)]
+
+        async def stop_workers():
+            for _ in metadata_workers:
+                projects_queue.put_nowait(None)
+            await asyncio.gather(*metadata_workers)
+            for _ in download_workers:
+                await download_queue.put(None)
+            await asyncio.gather(*download_workers)
+            if search_queue is not None:
+                await search_queue.put(None)
+
+        # If the search fails, don't wait forever for download workers
+        # blocked on the full search queue
+        tasks = [asyncio.create_task(stop_workers())]
+        if search_queue is not None:
+            tasks.append(search_task)
+        await wait_all(tasks)
+    finally:
+        await pool.close()
+        stats.retries = pool.retries
+        stats.limits = pool.limits()
+        if manifest is not None:
+            save_manifest(args.dst_dir, manifest)
+        if cache is not None:
+            cache.evict()
+    return nproject
 
 
 def parse_args():
@@ -87,15 +845,73 @@ def parse_args():
     parser.add_argument('count', metavar='COUNT', type=int, nargs='?',
                         help='Only download the top COUNT projects')
     parser.add_argument('-j', '--jobs', metavar='N', type=int, default=8,
-                        help='run N download jobs in parallel (default: %(default)s)')
+                        help='run up to N download jobs in parallel: send at most '
+                             'N concurrent requests per host, the actual limit '
+                             'is adaptive (default: %(default)s)')
+    parser.add_argument('--sync', action='store_true',
+                        help='Update a previous download: only download new '
+                             'and updated sdists, and remove old sdists')
+    parser.add_argument('--cache-dir', metavar='DIRECTORY', default=CACHE_DIR,
+                        help='Metadata cache directory (default: %(default)s)')
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None,
+                        help='Disable the metadata cache')
+    parser.add_argument('--cache-ttl', metavar='SECONDS', type=float, default=CACHE_TTL,
+                        help='Use cached metadata without revalidation if it is '
+                             'younger than SECONDS (default: %(default)s)')
+    parser.add_argument('--cache-size', metavar='MiB', type=int, default=CACHE_SIZE,
+                        help='Maximum metadata cache size in MiB (default: %(default)s)')
+    parser.add_argument('--grep', metavar='REGEX', action='append',
+                        help='Search REGEX in sdists while downloading them, '
+                             'can be used multiple times')
+    parser.add_argument('--grep-output', metavar='FILENAME',
+                        help='Write the --grep matching lines into FILENAME')
+    parser.add_argument('--grep-jobs', metavar='N', type=int,
+                        help='Run N search worker processes (default: number of CPUs)')
+    parser.add_argument('--top-url', metavar='URL', default=JSON_URL,
+                        help='URL of the top PyPI projects JSON (default: %(default)s)')
+    parser.add_argument('--index-url', metavar='URL', default=INDEX_URL,
+                        help='URL of the PyPI JSON API (default: %(default)s)')
+
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be greater than or equal to 1")
+    if args.grep_jobs is not None and args.grep_jobs < 1:
+        parser.error("--grep-jobs must be greater than or equal to 1")
+    if args.grep_output and not args.grep:
+        parser.error("--grep-output requires --grep")
+    if args.grep:
+        try:
+            re.compile(search_pypi_top.combine_patterns(
+                [os.fsencode(pattern) for pattern in args.grep]))
+        except (re.error, ValueError) as exc:
+            parser.error(f"invalid regex: {exc}")
+    args.index_url = args.index_url.rstrip('/')
+    return args
+
+
+def search_args(args):
+    # Default options of search_pypi_top.py
+    jobs = args.grep_jobs or os.cpu_count() or 1
+    return argparse.Namespace(
+        text=False, scan='buffer', use_index=False, format='text',
+        cache=None, jobs=jobs, window=2 * jobs)
+
 
-    return parser.parse_args()
+def display_search(search, dt):
+    patterns = [regex.pattern for regex in search.regexes]
+    print()
+    print(f"Download and search time: {dt:.1f} seconds")
+    if len(patterns) > 1:
+        print(f"Patterns ({len(patterns)}):")
+        for pattern, (pattern_lines, pattern_projects) in zip(patterns, search.pattern_stats):
+            print(f"- {search_pypi_top.format_pattern(pattern)}: "
+                  f"{pattern_lines} matching lines in {len(pattern_projects)} projects")
+    print(f"Found {search.lines} matching lines in {len(search.projects)} projects")
 
 
 def main():
     args = parse_args()
     dst_dir = args.dst_dir
-    count = args.count
     start_time = time.monotonic()
 
     try:
@@ -103,29 +919,34 @@ def main():
     except FileExistsError:
         pass
 
-    projs = projects()
-    if count:
-        projs = projs[:count]
-    nproject = len(projs)
-    print(f"Project#: {nproject}")
-
-    def download_wrapper(args):
-        dst_dir, index, proj, nproject = args
-        try:
-            download_sdist(dst_dir, index, proj, nproject)
-        except Exception:
-            traceback.print_exc()
-            cprint(f"Failed to download {proj}", "red")
-
-    max_workers = args.jobs
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        wrapper_args = [
-            (dst_dir, index, proj, nproject) for index, proj in enumerate(projs, start=1)]
-        for _ in executor.map(download_wrapper, wrapper_args):
-            pass
+    stats = Stats()
+    if args.grep:
+        # Only log errors: download_sdist() already logs each sdist
+        search_pypi_top.logger.setLevel(search_pypi_top.logging.ERROR)
+        patterns = [os.fsencode(pattern) for pattern in args.grep]
+        with contextlib.ExitStack() as stack:
+            if args.grep_output:
+                output = stack.enter_context(open(args.grep_output, "w", encoding="utf8"))
+            else:
+                output = None
+            # Spawn the worker processes before starting the event loop
+            search = search_pypi_top.SearchPool(search_args(args), dst_dir,
+                                                patterns, output)
+            try:
+                nproject = asyncio.run(download_all(args, stats, search))
+            except BaseException:
+                search.terminate()
+                raise
+            search.close()
+    else:
+        nproject = asyncio.run(download_all(args, stats))
 
     dt = time.monotonic() - start_time
-    cprint(f"Downloaded {nproject} projects in {dt:.1f} seconds", "green")
+    stats.display(nproject, dt)
+    if args.grep:
+        display_search(search, dt)
+        if args.grep_output:
+            print(f"Output written into: {args.grep_output}")
 
 
 if __name__ == "__main__":
@@ -1,4 +1,11 @@
 #!/usr/bin/env python3
+"""
+List projects affected by a search_pypi_top.py output file.
+
+Support the text format ("archive: member: line") and the JSON Lines format
+(--format=jsonl).
+"""
+import json
 import sys
 import os.path
 import re
@@ -15,6 +22,13 @@ with open(filename, encoding="utf8") as fp:
         line = line.rstrip()
         if not line:
             continue
+        if line.startswith('{'):
+            record = json.loads(line)
+            name = record["project"]
+            if record["version"]:
+                name = f'{name} ({record["version"]})'
+            projects.add(name)
+            continue
         filename = line.split(':')[0]
         filename = os.path.basename(filename)
         filename = filename.removesuffix('.tar.gz')
@@ -6,22 +6,59 @@ Usage::
 
     ./search_pypi_top.py --verbose PYPI_DIR/ REGEX -o output_file
 
+Search many regexes in a single pass, one regex per line::
+
+    ./search_pypi_top.py PYPI_DIR/ --patterns-file patterns.txt
+
+Build or update the trigram index of PYPI_DIR to speed up searches::
+
+    ./search_pypi_top.py index PYPI_DIR/
+
+When the index exists, only archives and members containing the trigrams
+required by the regex are decompressed and searched.
+
+Use --cache DIRECTORY to keep decompressed members between searches.
+
+Use --format=jsonl to write one JSON object per match into the output file:
+search_projects.py accepts this format.
+
 Use --help command line option to get the command line usage.
 
 Faster alternative but producing more false alarms:
 
-    rg -zl "REGEX" pypi_directory/*.{zip,gz,bz2,tgz}
+    rg -zl "REGEX" pypi_directory/*.{zip,gz,bz2,tgz,xz,zst}
 """
 import argparse
+import bz2
+import collections
+import contextlib
 import datetime
+import io
+import json
+import lzma
 import logging
+import mmap
 import os
+import pickle
+import queue
 import re
+import struct
 import sys
 import tarfile
+import threading
 import zipfile
-from itertools import repeat
+import zlib
+from itertools import count, islice, repeat
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    # Python 3.10 and older
+    import sre_parse
+    import sre_constants
 
 try:
     from termcolor import colored
@@ -36,11 +73,25 @@ except ImportError:
     def colored(msg, *ignored, **ignored2):
         return msg
 
+try:
+    # Python 3.14 and newer
+    from compression import zstd
+except ImportError:
+    zstd = None
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+
 
 IGNORE_CYTHON = True
 IGNORE_PYTHONCAPI_COMPAT = True
-# Ignore macOS directory metadata files from the initial directory listing
-DS_STORE = ".DS_Store"
+# Suffix of partial downloads of download_pypi_top.py
+DOWNLOAD_PART_SUFFIX = ".part"
+# Trigram index directory, created in the PyPI directory by the index command
+INDEX_DIRNAME = ".trigram_index"
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
 # Ignore file extensions known to be binary files to avoid the slow
 # is_binary_string() check
 IGNORED_FILE_EXTENSIONS = (
@@ -69,6 +120,48 @@ IGNORED_FILE_EXTENSIONS = tuple("." + ext.lower()
                                 for ext in IGNORED_FILE_EXTENSIONS)
 # Check the first bytes of a file to test if it's a binary file or not
 BINARY_TEST_LEN = 256
+# Only use literals of at least PREFILTER_MIN_LEN bytes to reject members
+PREFILTER_MIN_LEN = 3
+# Split ZIP archives bigger than SPLIT_SIZE bytes into tasks of about
+# SPLIT_SIZE compressed bytes, to not have a single worker searching a huge
+# archive at the end. TAR archives cannot be split: a member can only be
+# reached by decompressing all previous members.
+SPLIT_SIZE = 16 * 1024 * 1024
+# Cache of decompressed members (--cache option): one pack file per archive
+# which contains the members followed by the pickled offset table and the
+# offset of the table (unsigned 64-bit integer)
+PACK_SUFFIX = ".pack"
+PACK_VERSION = 1
+PACK_TRAILER = struct.Struct("<Q")
+DEFAULT_CACHE_SIZE = "20G"
+# TAR archives bigger than THREADED_SIZE bytes are decompressed in a thread
+# while tarfile parses the previous chunks
+THREADED_SIZE = 4 * 1024 * 1024
+DECOMPRESS_CHUNK = 1024 * 1024
+# Maximum number of decompressed chunks waiting to be parsed
+DECOMPRESS_QUEUE = 8
+# Number of threads to decompress bz2 archives made of multiple streams
+# (ex: created by pbzip2 or lbzip2)
+BZ2_THREADS = min(os.cpu_count() or 1, 4)
+# Start of a bz2 stream: "BZh", block size, block magic (pi digits)
+BZ2_STREAM_REGEX = re.compile(rb'BZh[1-9]\x31\x41\x59\x26\x53\x59')
+# Maximum size of a bz2 stream decompressed by a thread: a bigger stream is
+# decompressed sequentially
+BZ2_STREAM_MAX_SIZE = 16 * DECOMPRESS_CHUNK
+GZIP_MAGIC = b'\x1f\x8b'
+# Global inline flags at the start of a regex, like "(?i)"
+GLOBAL_FLAGS_REGEX = re.compile(rb'\(\?([aiLmsux]+)\)')
+TAR_COMPRESSIONS = (
+    ((".tar.gz", ".tgz"), "gz"),
+    ((".tar.bz2",), "bz2"),
+    ((".tar.xz",), "xz"),
+    ((".tar.zst",), "zst"),
+)
+ARCHIVE_SUFFIXES = tuple(suffix
+                         for suffixes, compression in TAR_COMPRESSIONS
+                         for suffix in suffixes) + (".zip",)
+# "project-1.2.3" => ("project", "1.2.3")
+ARCHIVE_VERSION_REGEX = re.compile(r'^(.*)-([0-9][^-]*)$')
 
 # "/* Generated by Cython 0.29.13 */"
 # "/* Generated by Cython 0.20.1 on Sun Mar 16 22:58:12 2014 */"
@@ -81,6 +174,31 @@ logger = multiprocessing.get_logger()
 logger.addHandler(handler)
 
 
+def parse_size(size):
+    """
+    Parse a size in bytes with an optional K, M, G or T suffix.
+
+    >>> parse_size("2K")
+    2048
+    """
+    units = "KMGT"
+    size = size.strip().upper()
+    factor = 1
+    if size and size[-1] in units:
+        factor = 1024 ** (units.index(size[-1]) + 1)
+        size = size[:-1]
+    return int(size) * factor
+
+
+def list_archives(pypi_dir):
+    # Ignore hidden files (.DS_Store, the trigram index, the manifest of
+    # download_pypi_top.py --sync) and partial downloads
+    filenames = (filename for filename in os.listdir(pypi_dir)
+                 if not filename.startswith('.')
+                 and not filename.endswith(DOWNLOAD_PART_SUFFIX))
+    return sorted(filenames, key=str.lower)
+
+
 def ignore_filename(args, filename):
     if args.text:
         return False
@@ -101,13 +219,268 @@ def is_binary_string(header):
     return bool(header.translate(None, TEXTCHARS))
 
 
-def decompress_tar(args, archive_filename, mode):
-    with tarfile.open(archive_filename, mode) as tar:
+class UnsupportedArchive(Exception):
+    pass
+
+
+def get_decompressor(compression):
+    if compression == "gz":
+        # Parse the gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == "bz2":
+        return bz2.BZ2Decompressor()
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    if compression == "zst":
+        if zstd is not None:
+            return zstd.ZstdDecompressor()
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise UnsupportedArchive("zstd requires Python 3.14 or the zstandard "
+                                 "module: python -m pip install --user zstandard")
+    raise ValueError(f"unknown compression: {compression!r}")
+
+
+def iter_decompress_data(decompressor, data):
+    """
+    Decompress data: yield chunks of at most DECOMPRESS_CHUNK bytes, to bound
+    the memory usage on highly compressed data.
+    """
+    if hasattr(decompressor, "needs_input"):
+        # bz2, lzma and zstd decompressors
+        while True:
+            yield decompressor.decompress(data, DECOMPRESS_CHUNK)
+            data = b''
+            if decompressor.eof or decompressor.needs_input:
+                break
+    else:
+        # zlib decompressor
+        while True:
+            chunk = decompressor.decompress(data, DECOMPRESS_CHUNK)
+            yield chunk
+            data = decompressor.unconsumed_tail
+            if decompressor.eof or (not data and len(chunk) < DECOMPRESS_CHUNK):
+                break
+
+
+def iter_decompress(chunks, compression):
+    """
+    Decompress an iterable of compressed chunks: yield decompressed chunks.
+
+    Support files made of multiple concatenated streams, but ignore trailing
+    garbage after a gzip stream.
+    """
+    decompressor = get_decompressor(compression)
+    started = False
+    pending = b''
+    for data in chunks:
+        if pending:
+            data = pending + data
+            pending = b''
+        while data:
+            if not started and compression == "gz":
+                if len(data) < len(GZIP_MAGIC):
+                    pending = data
+                    break
+                if not data.startswith(GZIP_MAGIC):
+                    # Trailing garbage after the last gzip member
+                    return
+            started = True
+            yield from iter_decompress_data(decompressor, data)
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data
+            decompressor = get_decompressor(compression)
+            started = False
+    if started:
+        raise EOFError("compressed file ended before the end-of-stream marker")
+
+
+def iter_file_chunks(filename):
+    with open(filename, "rb") as fp:
         while True:
+            data = fp.read(DECOMPRESS_CHUNK)
+            if not data:
+                break
+            yield data
+
+
+def decompress_bz2_stream(data):
+    decompressor = bz2.BZ2Decompressor()
+    result = decompressor.decompress(data, BZ2_STREAM_MAX_SIZE)
+    if not decompressor.eof or decompressor.unused_data:
+        # The stream start was a false positive, or the stream is too big
+        return None
+    return result
+
+
+def iter_bz2_streams(data, offsets):
+    """
+    Decompress bz2 streams in parallel in a thread pool: the bz2 module
+    releases the GIL while decompressing.
+
+    If a stream cannot be decompressed alone, decompress the remaining data
+    sequentially.
+    """
+    ends = offsets[1:] + [len(data)]
+    streams = iter(zip(offsets, ends))
+    pending = collections.deque()
+    with ThreadPoolExecutor(BZ2_THREADS) as executor:
+        try:
+            while True:
+                for start, end in islice(streams, 2 * BZ2_THREADS - len(pending)):
+                    future = executor.submit(decompress_bz2_stream, data[start:end])
+                    pending.append((start, future))
+                if not pending:
+                    break
+                start, future = pending.popleft()
+                result = future.result()
+                if result is None:
+                    for _, future in pending:
+                        future.cancel()
+                    pending.clear()
+                    chunks = (data[pos:pos + DECOMPRESS_CHUNK]
+                              for pos in range(start, len(data), DECOMPRESS_CHUNK))
+                    yield from iter_decompress(chunks, "bz2")
+                    return
+                yield result
+        finally:
+            # Don't wait for pending streams if the generator is closed
+            for _, future in pending:
+                future.cancel()
+
+
+def iter_zstandard_chunks(filename):
+    """
+    Decompress a zstd file with the zstandard module: its decompressobj()
+    cannot limit the output size, use a stream reader instead.
+    """
+    with open(filename, "rb") as fp:
+        decompressor = zstandard.ZstdDecompressor()
+        with decompressor.stream_reader(fp, read_size=DECOMPRESS_CHUNK,
+                                        read_across_frames=True) as reader:
+            while True:
+                data = reader.read(DECOMPRESS_CHUNK)
+                if not data:
+                    break
+                yield data
+
+
+def iter_decompressed_chunks(filename, compression):
+    if compression == "zst" and zstd is None:
+        yield from iter_zstandard_chunks(filename)
+        return
+    if compression == "bz2":
+        with open(filename, "rb") as fp:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offsets = [match.start() for match in BZ2_STREAM_REGEX.finditer(data)]
+                if BZ2_THREADS > 1 and len(offsets) > 1 and offsets[0] == 0:
+                    yield from iter_bz2_streams(data, offsets)
+                    return
+    yield from iter_decompress(iter_file_chunks(filename), compression)
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Read-only file object which gets data from an iterable of chunks consumed
+    by a thread.
+    """
+    def __init__(self, chunks):
+        super().__init__()
+        self._queue = queue.Queue(DECOMPRESS_QUEUE)
+        self._stop = threading.Event()
+        self._buffer = b''
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._produce, args=(chunks,),
+                                        daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, chunks):
+        try:
+            for chunk in chunks:
+                if chunk and not self._put(chunk):
+                    return
+        except BaseException as exc:
+            self._put(exc)
+        else:
+            self._put(None)
+        finally:
+            # Close the generator in this thread if the reader was closed
+            # before the end: release its files, mmap and thread pool now
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._pos >= len(self._buffer):
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, BaseException):
+                raise item
+            self._buffer = item
+            self._pos = 0
+        size = min(len(buffer), len(self._buffer) - self._pos)
+        buffer[:size] = self._buffer[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+        super().close()
+
+
+@contextlib.contextmanager
+def open_tar(archive_filename, compression):
+    """
+    Open a TAR archive.
+
+    Small archives are opened by tarfile. Big archives are decompressed in a
+    thread and parsed by tarfile in stream mode.
+
+    Return (tar, stream) where stream is true in stream mode.
+    """
+    size = os.path.getsize(archive_filename)
+    if size < THREADED_SIZE and compression != "zst":
+        with tarfile.open(archive_filename, f"r:{compression}") as tar:
+            yield tar, False
+        return
+
+    # Check that the compression is supported before starting the thread
+    get_decompressor(compression)
+    chunks = iter_decompressed_chunks(archive_filename, compression)
+    with io.BufferedReader(ThreadedReader(chunks), DECOMPRESS_CHUNK) as fp:
+        with tarfile.open(fileobj=fp, mode="r|") as tar:
+            yield tar, True
+
+
+def decompress_tar(args, archive_filename, compression, members=None):
+    with open_tar(archive_filename, compression) as (tar, stream):
+        for index in count():
             member = tar.next()
             if member is None:
                 break
             filename = member.name
+            if members is not None and filename not in members:
+                continue
             if ignore_filename(args, filename):
                 log_ignored_file(archive_filename, filename)
                 continue
@@ -115,6 +488,9 @@ def decompress_tar(args, archive_filename, mode):
                 fp = tar.extractfile(member)
                 if fp is None:
                     continue
+            except tarfile.StreamError:
+                # Links cannot be extracted in stream mode
+                continue
             except KeyError:
                 # graphitesend-0.10.0.tar.gz fails with:
                 #  File "tarfile.py", line 2124, in extractfile
@@ -125,135 +501,954 @@ def decompress_tar(args, archive_filename, mode):
                 continue
 
             with fp:
-                yield filename, fp
+                yield index, filename, fp
 
 
-def decompress_zip(args, archive_filename):
+def decompress_zip(args, archive_filename, members=None, member_range=None):
     with zipfile.ZipFile(archive_filename) as zf:
-        for member in zf.filelist:
+        filelist = enumerate(zf.filelist)
+        if member_range is not None:
+            filelist = islice(filelist, *member_range)
+        for index, member in filelist:
             filename = member.filename
+            if members is not None and filename not in members:
+                continue
             if ignore_filename(args, filename):
                 log_ignored_file(archive_filename, filename)
                 continue
             with zf.open(member) as fp:
-                yield filename, fp
+                yield index, filename, fp
 
 
-def decompress(args, filename):
-    if filename.endswith((".tar.gz", ".tgz")):
-        yield from decompress_tar(args, filename, "r:gz")
-    elif filename.endswith(".tar.bz2"):
-        yield from decompress_tar(args, filename, "r:bz2")
-    elif filename.endswith(".zip"):
-        yield from decompress_zip(args, filename)
+def decompress_archive(args, filename, members=None, member_range=None):
+    for suffixes, compression in TAR_COMPRESSIONS:
+        if filename.endswith(suffixes):
+            yield from decompress_tar(args, filename, compression, members)
+            return
+    if filename.endswith(".zip"):
+        yield from decompress_zip(args, filename, members, member_range)
     else:
         raise Exception(f"unsupported filename: {filename!r}")
 
 
-def is_binary_file(args, fp):
-    if args.text:
-        return False
-    data = fp.read(BINARY_TEST_LEN)
-    fp.seek(0)
-    if is_binary_string(data):
-        return True
-    return False
+def get_pack_filename(cache_dir, archive_filename):
+    return os.path.join(cache_dir, os.path.basename(archive_filename) + PACK_SUFFIX)
 
 
-def grep(args, archive_filename, regex):
-    for filename, fp in decompress(args, archive_filename):
-        if is_binary_file(args, fp):
-            logger.info(f"ignore binary file: {archive_filename}: {filename}")
+def pack_header(archive_filename):
+    st = os.stat(archive_filename)
+    return {"version": PACK_VERSION, "mtime": st.st_mtime_ns, "size": st.st_size}
+
+
+def open_pack(args, archive_filename):
+    """
+    Open the pack file of an archive.
+
+    Return (header, text, table, data) where data is a mmap, or None if the
+    pack file is missing or outdated.
+    """
+    pack_filename = get_pack_filename(args.cache, archive_filename)
+    try:
+        fp = open(pack_filename, "rb")
+    except FileNotFoundError:
+        return None
+    with fp:
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return None
+    try:
+        table_offset, = PACK_TRAILER.unpack_from(data, len(data) - PACK_TRAILER.size)
+        header, text, table = pickle.loads(data[table_offset:-PACK_TRAILER.size])
+    except (struct.error, pickle.UnpicklingError, EOFError, ValueError):
+        logger.info(f"ignore corrupted pack file: {pack_filename}")
+        data.close()
+        return None
+    # Members ignored by the pack are required by the --text option
+    if header != pack_header(archive_filename) or (args.text and not text):
+        data.close()
+        return None
+    # Update the modification time for the LRU eviction
+    os.utime(pack_filename)
+    return header, text, table, data
+
+
+def read_pack(args, archive_filename, pack, members, member_range):
+    header, text, table, data = pack
+    with data:
+        for filename, index, offset, size in table:
+            if members is not None and filename not in members:
+                continue
+            if member_range is not None and not (member_range[0] <= index < member_range[1]):
+                continue
+            if text and ignore_filename(args, filename):
+                log_ignored_file(archive_filename, filename)
+                continue
+            yield filename, io.BytesIO(data[offset:offset + size])
+
+
+def fill_pack(args, archive_filename, entries, members):
+    """
+    Write the pack file of an archive while yielding its members.
+
+    The pack file is only written if all members have been read.
+    """
+    header = pack_header(archive_filename)
+    pack_filename = get_pack_filename(args.cache, archive_filename)
+    tmp_filename = f"{pack_filename}.{os.getpid()}.tmp"
+    table = []
+    try:
+        with open(tmp_filename, "wb") as pack:
+            for index, filename, fp in entries:
+                data = fp.read()
+                table.append((filename, index, pack.tell(), len(data)))
+                pack.write(data)
+                if members is None or filename in members:
+                    yield filename, io.BytesIO(data)
+
+            table_offset = pack.tell()
+            pickle.dump((header, args.text, table), pack)
+            pack.write(PACK_TRAILER.pack(table_offset))
+        os.replace(tmp_filename, pack_filename)
+    finally:
+        try:
+            os.unlink(tmp_filename)
+        except FileNotFoundError:
+            pass
+
+
+def decompress(args, filename, members=None, member_range=None):
+    """
+    Iterate on (member name, file object) of an archive.
+
+    If members is not None, only yield members from this set. If
+    member_range is not None, only yield members in the (start, stop) range
+    of member indexes: only supported by ZIP archives.
+
+    If the --cache option is used, read the members from the pack file of
+    the archive. If the pack file is missing or outdated, write it while
+    decompressing the whole archive, except for a ZIP archive when only
+    some members are requested.
+    """
+    if member_range is not None and not filename.endswith(".zip"):
+        raise ValueError(f"member range requires a ZIP archive: {filename!r}")
+
+    if args.cache:
+        pack = open_pack(args, filename)
+        if pack is not None:
+            yield from read_pack(args, filename, pack, members, member_range)
+            return
+        # ZIP members are decompressed individually: only fill the pack if
+        # all members are needed. TAR members are decompressed sequentially
+        # anyway.
+        if member_range is None and (members is None or not filename.endswith(".zip")):
+            entries = decompress_archive(args, filename)
+            yield from fill_pack(args, filename, entries, members)
+            return
+
+    for index, name, fp in decompress_archive(args, filename, members, member_range):
+        yield name, fp
+
+
+def evict_cache(cache_dir, max_size):
+    """
+    Remove the least recently used pack files until the cache size is
+    smaller than or equal to max_size bytes.
+    """
+    packs = []
+    total = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith(PACK_SUFFIX):
             continue
+        st = entry.stat()
+        packs.append((st.st_mtime, st.st_size, entry.path))
+        total += st.st_size
+    packs.sort()
+
+    removed = 0
+    for mtime, size, path in packs:
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    if removed:
+        logger.info(f"cache: removed {removed} pack files")
+
+
+def is_cython_file(head):
+    return IGNORE_CYTHON and CYTHON_REGEX.match(head)
+
+
+def scan_lines(fp, regex):
+    """
+    Search regex in each line of fp.
+
+    Return a list of (lineno, offset, line, span) tuples.
+    """
+    matches = []
+    offset = 0
+    # Split at Unix newline b'\n' byte
+    for lineno, line in enumerate(fp, 1):
+        match = regex.search(line)
+        if match:
+            matches.append((lineno, offset, line, match.span()))
+        offset += len(line)
+    return matches
+
+
+def scan_buffer(data, regex, buffer_regex):
+    """
+    Search regex in the whole data buffer.
+
+    buffer_regex is regex compiled with the re.MULTILINE flag. Only lines
+    containing a match are extracted: line numbers are computed from the
+    number of newlines before the match. The line is searched again with
+    regex to get exactly the same result than scan_lines(), except for
+    regexes for which needs_line_scan() returns True.
+
+    Return a list of (lineno, offset, line, span) tuples.
+    """
+    matches = []
+    size = len(data)
+    pos = 0
+    lineno = 1
+    lineno_pos = 0
+    while pos < size:
+        match = buffer_regex.search(data, pos)
+        if match is None:
+            break
+        start = match.start()
+        line_start = data.rfind(b'\n', pos, start) + 1
+        if not line_start:
+            line_start = pos
+        line_end = data.find(b'\n', start)
+        if line_end < 0:
+            line_end = size
+        else:
+            line_end += 1
+
+        line = data[line_start:line_end]
+        match = regex.search(line)
+        if match:
+            lineno += data.count(b'\n', lineno_pos, line_start)
+            lineno_pos = line_start
+            matches.append((lineno, line_start, line, match.span()))
+        pos = line_end
+    return matches
+
+
+# Line matching a regex in an archive member: offset is the offset in bytes
+# of the line in the member, span is the (start, end) of the match in the line
+Match = collections.namedtuple('Match', 'filename lineno offset line span')
+
+
+def get_prefilter(regexes):
+    """
+    Get the literals required by each regex, longest literals first.
+
+    Return None if a regex has no required literal.
+    """
+    prefilter = []
+    for regex in regexes:
+        literals = {literal for literal in required_literals(regex)
+                    if len(literal) >= PREFILTER_MIN_LEN}
+        if not literals:
+            return None
+        prefilter.append(sorted(literals, key=len, reverse=True))
+    return prefilter
+
+
+def match_prefilter(prefilter, data):
+    """
+    Return True if data contains all literals required by at least one
+    regex.
+    """
+    return any(all(literal in data for literal in literals)
+               for literals in prefilter)
+
+
+def grep(args, archive_filename, regex, members=None, member_range=None,
+         prefilter=None):
+    """
+    Search regex in the members of an archive.
+
+    In buffer scan mode, if prefilter is not None (see get_prefilter()),
+    members which don't contain the required literals are skipped without
+    running the regex. Regexes which need a line scan (see
+    needs_line_scan()) are searched line by line.
+    """
+    scan_lines_only = (args.scan == "lines" or needs_line_scan(regex))
+    buffer_regex = re.compile(regex.pattern, regex.flags | re.MULTILINE)
+    for filename, fp in decompress(args, archive_filename, members, member_range):
         if (IGNORE_PYTHONCAPI_COMPAT
            and os.path.basename(filename) == 'pythoncapi_compat.h'):
             logger.info(f"ignore: {filename}")
             continue
 
-        matches = []
-        ignore = False
-        lineno = 1
-        # Split at Unix newline b'\n' byte
-        for line in fp:
-            if lineno == 1 and IGNORE_CYTHON and CYTHON_REGEX.match(line):
-                logger.info(f"ignore Cython file: {archive_filename}: {filename}")
-                ignore = True
-                break
-            match = regex.search(line)
-            if match:
-                matches.append((filename, line, match.span()))
-            lineno += 1
+        # Read the member once: seeking backwards in a decompressed stream
+        # requires to decompress it again
+        head = fp.read(BINARY_TEST_LEN)
+        if not args.text and is_binary_string(head):
+            logger.info(f"ignore binary file: {archive_filename}: {filename}")
+            continue
+        if is_cython_file(head):
+            logger.info(f"ignore Cython file: {archive_filename}: {filename}")
+            continue
+        data = head + fp.read()
 
-        if matches and not ignore:
-            yield from matches
+        if scan_lines_only:
+            matches = scan_lines(io.BytesIO(data), regex)
+        else:
+            if prefilter is not None and not match_prefilter(prefilter, data):
+                continue
+            matches = scan_buffer(data, regex, buffer_regex)
 
+        for lineno, offset, line, span in matches:
+            yield Match(filename, lineno, offset, line, span)
 
-def search_file(filename, index, len_filenames, args, pypi_dir, regex):
-    lines = 0
-    results = []
-    filename = os.path.join(pypi_dir, filename)
-    percent = index * 100 / len_filenames
-    logger.warning(f"grep {filename} ({percent:.0f}%, {index}/{len_filenames})")
 
-    for name, line, span in grep(args, filename, regex):
-        line = line.decode('utf8', 'replace')
+def _required_literals(items, literals, current):
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            current.append(av)
+            continue
+        if op is sre_constants.AT:
+            # Anchors like ^ or \b don't consume characters
+            continue
+        if op is sre_constants.SUBPATTERN:
+            group, add_flags, del_flags, pattern = av
+            if not (add_flags & sre_constants.SRE_FLAG_IGNORECASE):
+                current = _required_literals(pattern, literals, current)
+                continue
+        if current:
+            literals.append(bytes(current))
+            current = bytearray()
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_repeat, max_repeat, pattern = av
+            if min_repeat >= 1:
+                sub = _required_literals(pattern, literals, bytearray())
+                if sub:
+                    literals.append(bytes(sub))
+    return current
+
 
-        # print to terminal with color
-        start, end = span
-        line_color = (
-            line[:start] + colored(line[start:end], "red", attrs=["bold"]) + line[end:]
-        )
-        name_color = colored(name, "magenta")
-        result = f"{filename}: {name_color}: {line_color.strip()}"
-        print(result, flush=True)
+def required_literals(regex):
+    """
+    Get the list of byte strings which must be present in a line matched by
+    the compiled regex. Return an empty list if no literal is required.
+    """
+    if regex.flags & re.IGNORECASE:
+        return []
+    items = sre_parse.parse(regex.pattern, regex.flags)
+    literals = []
+    current = _required_literals(items, literals, bytearray())
+    if current:
+        literals.append(bytes(current))
+    return literals
 
-        # print to file without color
-        result = f"{filename}: {name}: {line.strip()}"
-        results.append(result)
-        lines += 1
 
-    return lines, filename if lines >= 1 else None, results
+def trigrams(data):
+    return {data[i:i+3] for i in range(len(data) - 2)}
 
 
-def search_dir(args, pypi_dir, pattern):
-    lines = 0
-    projects = set()
-    all_results = []
-    regex = re.compile(pattern)
-    filenames = (filename for filename in os.listdir(pypi_dir) if filename != DS_STORE)
-    filenames = sorted(filenames, key=str.lower)
+def regex_trigrams(regex):
+    required = set()
+    for literal in required_literals(regex):
+        required |= trigrams(literal)
+    return required
+
+
+def get_index_filename(archive_filename):
+    pypi_dir, name = os.path.split(archive_filename)
+    return os.path.join(pypi_dir, INDEX_DIRNAME, name + INDEX_SUFFIX)
+
+
+def index_header(archive_filename):
+    st = os.stat(archive_filename)
+    return {"version": INDEX_VERSION, "mtime": st.st_mtime_ns, "size": st.st_size}
 
-    with multiprocessing.Pool() as pool:
+
+def read_index_header(fp):
+    try:
+        return pickle.load(fp)
+    except (EOFError, pickle.UnpicklingError):
+        return None
+
+
+def is_index_valid(archive_filename, index_filename):
+    try:
+        fp = open(index_filename, "rb")
+    except FileNotFoundError:
+        return False
+    with fp:
+        header = read_index_header(fp)
+    return header == index_header(archive_filename)
+
+
+def index_archive(args, archive_filename):
+    """
+    Write the trigram index of an archive.
+
+    The index file contains a header (archive version, mtime and size), the
+    list of member names and the posting lists: a dict which maps a trigram
+    to a bitmap (int) of the members containing it.
+    """
+    header = index_header(archive_filename)
+    members = []
+    postings = {}
+    for filename, fp in decompress(args, archive_filename):
+        data = fp.read()
+        if is_binary_string(data[:BINARY_TEST_LEN]):
+            continue
+        bit = 1 << len(members)
+        members.append(filename)
+        for trigram in trigrams(data):
+            postings[trigram] = postings.get(trigram, 0) | bit
+
+    index_filename = get_index_filename(archive_filename)
+    tmp_filename = index_filename + ".tmp"
+    with open(tmp_filename, "wb") as fp:
+        pickle.dump(header, fp)
+        pickle.dump((members, postings), fp)
+    os.replace(tmp_filename, index_filename)
+    return len(members)
+
+
+def index_file(filename, index, len_filenames, args, pypi_dir):
+    filename = os.path.join(pypi_dir, filename)
+    percent = index * 100 / len_filenames
+    logger.warning(f"index {filename} ({percent:.0f}%, {index}/{len_filenames})")
+    try:
+        return index_archive(args, filename)
+    except UnsupportedArchive as exc:
+        logger.error(f"ignore {filename}: {exc}")
+        return 0
+
+
+def index_dir(args, pypi_dir):
+    index_path = os.path.join(pypi_dir, INDEX_DIRNAME)
+    os.makedirs(index_path, exist_ok=True)
+
+    filenames = list_archives(pypi_dir)
+    # Remove the index of archives which are gone
+    index_names = {filename + INDEX_SUFFIX for filename in filenames}
+    removed = 0
+    for name in os.listdir(index_path):
+        if name not in index_names:
+            os.unlink(os.path.join(index_path, name))
+            removed += 1
+
+    outdated = [filename for filename in filenames
+                if not is_index_valid(os.path.join(pypi_dir, filename),
+                                      os.path.join(index_path, filename + INDEX_SUFFIX))]
+    # Index the largest archives first
+    outdated.sort(key=lambda filename: os.path.getsize(os.path.join(pypi_dir, filename)),
+                  reverse=True)
+    with multiprocessing.Pool(args.jobs) as pool:
         ret = pool.starmap(
-            search_file,
+            index_file,
             zip(
-                filenames,
-                range(len(filenames)),
-                repeat(len(filenames)),
+                outdated,
+                range(len(outdated)),
+                repeat(len(outdated)),
                 repeat(args),
                 repeat(pypi_dir),
-                repeat(regex),
-            )
+            ),
+            chunksize=1,
         )
-        for new_lines, new_project, results in ret:
-            lines += new_lines
-            if new_project:
-                projects.add(new_project)
-            all_results.extend(results)
-    pool.close()
-    pool.join()
+    members = sum(ret)
+    if args.cache:
+        evict_cache(args.cache, args.cache_size)
+    return len(filenames), len(outdated), members, removed
+
+
+def read_index(archive_filename):
+    """
+    Read the trigram index of an archive.
+
+    Return None if the index is missing or outdated.
+    """
+    try:
+        fp = open(get_index_filename(archive_filename), "rb")
+    except FileNotFoundError:
+        return None
+    with fp:
+        header = read_index_header(fp)
+        if header != index_header(archive_filename):
+            return None
+        return pickle.load(fp)
+
+
+def index_candidates(args, archive_filename, required):
+    """
+    Get the set of member names which can match the regex.
+
+    required is a list of trigram sets: one set per pattern. A member is a
+    candidate if it contains all trigrams of at least one pattern.
+
+    Return None if all members must be searched.
+    """
+    if args.text or not args.use_index or not required:
+        return None
+    index = read_index(archive_filename)
+    if index is None:
+        logger.info(f"no up to date index: {archive_filename}")
+        return None
+    members, postings = index
+    candidates = 0
+    for trigrams in required:
+        bitmap = -1
+        for trigram in trigrams:
+            bitmap &= postings.get(trigram, 0)
+            if not bitmap:
+                break
+        candidates |= bitmap
+    if not candidates:
+        return set()
+    return {name for index, name in enumerate(members) if candidates & (1 << index)}
+
+
+def format_pattern(pattern):
+    return pattern.decode('utf8', 'replace')
+
+
+def read_patterns(filename):
+    """
+    Read a file of regexes: one regex per line, empty lines are ignored.
+    """
+    with open(filename, "rb") as fp:
+        patterns = [line.rstrip(b"\r\n") for line in fp]
+    return [pattern for pattern in patterns if pattern]
+
+
+def _iter_items(items):
+    """
+    Iterate on the (op, av) items of a parsed regex and of its
+    subpatterns.
+    """
+    for op, av in items:
+        yield op, av
+        if not isinstance(av, (tuple, list)):
+            av = (av,)
+        for arg in av:
+            if isinstance(arg, sre_parse.SubPattern):
+                yield from _iter_items(arg)
+            elif isinstance(arg, (tuple, list)):
+                for item in arg:
+                    if isinstance(item, sre_parse.SubPattern):
+                        yield from _iter_items(item)
+
+
+def _has_backreference(items):
+    return any(op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS)
+               for op, av in _iter_items(items))
+
+
+def needs_line_scan(regex):
+    r"""
+    Return True if regex must be searched by scan_lines(): scan_buffer()
+    can give a different result.
+
+    \A and \Z match at the start and at the end of each line in
+    scan_lines(), whereas lookahead and lookbehind assertions can see the
+    previous and next lines in scan_buffer().
+
+    >>> needs_line_scan(re.compile(rb'^PyObject'))
+    False
+    >>> needs_line_scan(re.compile(rb'\APyObject'))
+    True
+    >>> needs_line_scan(re.compile(rb'(?<!_)PyObject'))
+    True
+    """
+    for op, av in _iter_items(sre_parse.parse(regex.pattern, regex.flags)):
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            return True
+        if op is sre_constants.AT and av in (sre_constants.AT_BEGINNING_STRING,
+                                             sre_constants.AT_END_STRING):
+            return True
+    return False
+
+
+def combine_patterns(patterns):
+    """
+    Combine multiple regexes into a single regex: an alternation.
+
+    Global inline flags, like "(?i)", are rewritten as scoped flags. Raise
+    re.error if a pattern is invalid, or ValueError if a pattern uses named
+    groups or backreferences, since group names and numbers change in the
+    combined regex.
+
+    >>> combine_patterns([b"foo", b"(?i)bar"])
+    b'(?:foo)|(?i:bar)'
+    """
+    if len(patterns) == 1:
+        return patterns[0]
+    parts = []
+    for pattern in patterns:
+        regex = re.compile(pattern)
+        if regex.groupindex or _has_backreference(sre_parse.parse(pattern)):
+            raise ValueError(f"regex {format_pattern(pattern)!r} uses named "
+                             f"groups or backreferences: it cannot be combined "
+                             f"with other regexes")
+        flags = b""
+        while match := GLOBAL_FLAGS_REGEX.match(pattern):
+            flags += match.group(1)
+            pattern = pattern[match.end():]
+        if b"x" in flags:
+            # Don't let a trailing comment hide the closing parenthesis
+            pattern += b"\n"
+        parts.append(b"(?%s:%s)" % (flags, pattern))
+    return b"|".join(parts)
+
+
+def split_archive(filename):
+    """
+    Split a ZIP archive into (start, stop) ranges of member indexes of about
+    SPLIT_SIZE compressed bytes.
+
+    Return a list of (member_range, size) tuples.
+    """
+    with zipfile.ZipFile(filename) as zf:
+        filelist = zf.filelist
+    ranges = []
+    start = 0
+    size = 0
+    for index, member in enumerate(filelist):
+        size += member.compress_size
+        if size >= SPLIT_SIZE:
+            ranges.append(((start, index + 1), size))
+            start = index + 1
+            size = 0
+    if start < len(filelist):
+        ranges.append(((start, len(filelist)), size))
+    return ranges
+
+
+def schedule_tasks(pypi_dir, filenames):
+    """
+    Create the list of (filename, member_range) tasks, largest tasks first.
+
+    member_range is None to search the whole archive.
+    """
+    tasks = []
+    for filename in filenames:
+        size = os.path.getsize(os.path.join(pypi_dir, filename))
+        if size > SPLIT_SIZE and filename.endswith(".zip"):
+            try:
+                ranges = split_archive(os.path.join(pypi_dir, filename))
+            except zipfile.BadZipFile:
+                # Let search_file() report the error
+                ranges = [(None, size)]
+            for member_range, part_size in ranges:
+                tasks.append((part_size, filename, member_range))
+        else:
+            tasks.append((size, filename, None))
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return [(filename, member_range) for size, filename, member_range in tasks]
+
+
+def parse_archive_name(filename):
+    """
+    Get the (project, version) of an archive filename.
+
+    >>> parse_archive_name("pypi/Cython-0.29.32.tar.gz")
+    ('Cython', '0.29.32')
+    """
+    name = os.path.basename(filename)
+    for suffix in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    match = ARCHIVE_VERSION_REGEX.match(name)
+    if match is None:
+        return name, None
+    return match.groups()
+
+
+def decode_span(line, span):
+    """
+    Convert a (start, end) span of byte offsets in line into character
+    offsets in the line decoded from UTF-8.
+
+    >>> decode_span("caf\u00e9 = 1".encode(), (6, 7))
+    (5, 6)
+    """
+    start, end = span
+    return (len(line[:start].decode('utf8', 'replace')),
+            len(line[:end].decode('utf8', 'replace')))
+
+
+def format_json_match(filename, match, line, patterns):
+    """
+    Format a match as a JSON object written on a single line.
+
+    "offset" is the offset in bytes of the match in the member, whereas
+    "span" is the (start, end) of the match in characters of "line".
+    """
+    project, version = parse_archive_name(filename)
+    start, end = decode_span(match.line, match.span)
+    record = {
+        "archive": os.path.basename(filename),
+        "project": project,
+        "version": version,
+        "member": match.filename,
+        "lineno": match.lineno,
+        "offset": match.offset + match.span[0],
+        "span": [start, end],
+        "line": line.rstrip("\r\n"),
+        "patterns": [format_pattern(pattern) for pattern in patterns],
+    }
+    return json.dumps(record, ensure_ascii=False)
+
+
+def search_file(filename, member_range, index, len_tasks, args, pypi_dir,
+                regex, regexes, required, prefilter):
+    lines = 0
+    results = []
+    pattern_lines = [0] * len(regexes)
+    filename = os.path.join(pypi_dir, filename)
+    percent = index * 100 / len_tasks
+    candidates = index_candidates(args, filename, required)
+    if candidates is not None and not candidates:
+        logger.info(f"skip {filename}: no candidate member in the index")
+        return lines, None, results, pattern_lines
+    if member_range is not None:
+        start, stop = member_range
+        name = f"{filename} [members {start}..{stop - 1}]"
+    else:
+        name = filename
+    logger.warning(f"grep {name} ({percent:.0f}%, {index}/{len_tasks})")
+
+    try:
+        for match in grep(args, filename, regex, candidates, member_range, prefilter):
+            name = match.filename
+            line = match.line.decode('utf8', 'replace')
+            if len(regexes) > 1:
+                # Find which patterns match the line
+                matched = [pattern_index
+                           for pattern_index, pattern_regex in enumerate(regexes)
+                           if pattern_regex.search(match.line)]
+                label = ", ".join(format_pattern(regexes[pattern_index].pattern)
+                                  for pattern_index in matched)
+                label = f"[{label}] "
+                label_color = colored(label, "cyan")
+            else:
+                matched = [0]
+                label = label_color = ""
+            for pattern_index in matched:
+                pattern_lines[pattern_index] += 1
+
+            # print to terminal with color
+            start, end = decode_span(match.line, match.span)
+            line_color = (
+                line[:start] + colored(line[start:end], "red", attrs=["bold"]) + line[end:]
+            )
+            name_color = colored(name, "magenta")
+            result = f"{filename}: {name_color}: {label_color}{line_color.strip()}"
+            print(result, flush=True)
+
+            # print to file without color
+            if args.format == "jsonl":
+                result = format_json_match(filename, match, line,
+                                           [regexes[pattern_index].pattern
+                                            for pattern_index in matched])
+            else:
+                result = f"{filename}: {name}: {label}{line.strip()}"
+            results.append(result)
+            lines += 1
+    except UnsupportedArchive as exc:
+        logger.error(f"ignore {filename}: {exc}")
+
+    return lines, filename if lines >= 1 else None, results, pattern_lines
+
+
+def write_results(output, results):
+    if output is None or not results:
+        return
+    for result in results:
+        print(result, file=output)
+    output.flush()
+
+
+class SearchPool:
+    """
+    Pool of worker processes searching patterns in archives of pypi_dir.
+
+    Multiple patterns are searched in a single pass using a single regex,
+    the patterns matching a line are only searched on matching lines.
+
+    Tasks are submitted by submit(), and results are written into output by
+    wait_result(). Matching lines and projects are counted in the lines,
+    projects and pattern_stats attributes, pattern_stats is a list of
+    (lines, projects) per pattern.
+    """
+    def __init__(self, args, pypi_dir, patterns, output=None):
+        self.args = args
+        self.pypi_dir = pypi_dir
+        self.output = output
+        self.lines = 0
+        self.projects = set()
+        self.pattern_stats = [(0, set()) for pattern in patterns]
+        self.inflight = 0
+
+        self.regexes = [re.compile(pattern) for pattern in patterns]
+        self.regex = re.compile(combine_patterns(patterns))
+        required = [regex_trigrams(pattern_regex) for pattern_regex in self.regexes]
+        if not all(required):
+            required = None
+        self.required = required
+        self.prefilter = get_prefilter(self.regexes)
+        if self.prefilter is not None:
+            for pattern, literals in zip(patterns, self.prefilter):
+                literals = ", ".join(repr(literal) for literal in literals)
+                logger.info(f"prefilter: {format_pattern(pattern)}: {literals}")
+        else:
+            logger.info("no literal prefilter: a regex has no required literal")
+        if args.use_index and not os.path.isdir(os.path.join(pypi_dir, INDEX_DIRNAME)):
+            args.use_index = False
+        if args.use_index:
+            if required:
+                logger.info(f"use the trigram index: {sum(map(len, required))} required trigrams")
+            else:
+                logger.info("a regex has no required trigram: ignore the index")
+
+        self._results_queue = queue.SimpleQueue()
+        self._pool = multiprocessing.Pool(args.jobs)
+
+    def submit(self, filename, member_range, index, len_tasks):
+        self._pool.apply_async(
+            search_file,
+            (filename, member_range, index, len_tasks,
+             self.args, self.pypi_dir, self.regex, self.regexes,
+             self.required, self.prefilter),
+            callback=self._results_queue.put,
+            error_callback=self._results_queue.put)
+        self.inflight += 1
+
+    def wait_result(self):
+        """
+        Wait for the result of a task and write it into output.
+        """
+        result = self._results_queue.get()
+        self.inflight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        new_lines, new_project, results, pattern_lines = result
+        self.lines += new_lines
+        if new_project:
+            self.projects.add(new_project)
+        for pattern_index, new_lines in enumerate(pattern_lines):
+            if new_lines:
+                total_lines, pattern_projects = self.pattern_stats[pattern_index]
+                pattern_projects.add(new_project)
+                self.pattern_stats[pattern_index] = (total_lines + new_lines, pattern_projects)
+        write_results(self.output, results)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        if self.args.cache:
+            evict_cache(self.args.cache, self.args.cache_size)
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def search_dir(args, pypi_dir, patterns, output=None):
+    """
+    Search patterns in all archives of pypi_dir.
+
+    Results are written into output as soon as an archive is searched. At
+    most args.window tasks are searched or waiting for their results to be
+    written at the same time, which bounds the memory usage.
+
+    Archives are searched largest first, one task at a time per worker, and
+    huge ZIP archives are split into multiple tasks.
+
+    Return (lines, projects, pattern_stats) where pattern_stats is a list of
+    (lines, projects) per pattern.
+    """
+    search = SearchPool(args, pypi_dir, patterns, output)
+    try:
+        tasks = schedule_tasks(pypi_dir, list_archives(pypi_dir))
+        len_tasks = len(tasks)
+        tasks = enumerate(tasks)
+        while True:
+            for index, (filename, member_range) in islice(tasks, args.window - search.inflight):
+                search.submit(filename, member_range, index, len_tasks)
+            if not search.inflight:
+                break
+            search.wait_result()
+    except BaseException:
+        search.terminate()
+        raise
+    search.close()
+
+    return search.lines, search.projects, search.pattern_stats
+
+
+def add_cache_args(parser):
+    parser.add_argument('--cache', metavar='DIRECTORY',
+                        help='Cache decompressed members in DIRECTORY')
+    parser.add_argument('--cache-size', metavar='SIZE', type=parse_size,
+                        default=DEFAULT_CACHE_SIZE,
+                        help='Maximum cache size, the least recently used '
+                             'archives are removed (default: %(default)s)')
 
-    return lines, projects, all_results
+
+def check_cache_args(args):
+    if args.cache:
+        os.makedirs(args.cache, exist_ok=True)
+
+
+def parse_index_args(argv):
+    parser = argparse.ArgumentParser(
+        prog=f"{os.path.basename(sys.argv[0])} index",
+        description='Build or update the trigram index of a PyPI local directory.')
+    parser.add_argument('pypi_dir', metavar="PYPI_DIRECTORY",
+                        help='PyPI local directory')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Verbose mode (ex: log ignored files)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="Quiet mode (ex: don't log proceed files)")
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='Run N worker processes (default: number of CPUs)')
+    add_cache_args(parser)
+
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be greater than or equal to 1")
+    check_cache_args(args)
+    args.command = "index"
+    # The index only contains text files
+    args.text = False
+    return args
 
 
 def parse_args():
+    if sys.argv[1:2] == ["index"]:
+        return parse_index_args(sys.argv[2:])
+
     parser = argparse.ArgumentParser(description='Code search in the source code of PyPI top projects.')
     parser.add_argument('pypi_dir', metavar="PYPI_DIRECTORY",
                         help='PyPI local directory')
-    parser.add_argument('pattern', metavar='REGEX',
+    parser.add_argument('pattern', metavar='REGEX', nargs='?',
                         help='Regex to search')
+    parser.add_argument('-f', '--patterns-file', metavar='FILENAME',
+                        help='Search all regexes of FILENAME (one regex per '
+                             'line) in a single pass')
     parser.add_argument('-o', '--output', metavar='FILENAME',
                         help='Output filename')
+    parser.add_argument('--format', choices=('text', 'jsonl'), default='text',
+                        help='Output file format: "archive: member: line" text '
+                             'lines, or JSON Lines with one JSON object per '
+                             'match (default: %(default)s)')
     parser.add_argument('--text', action='store_true',
                         help='Process a binary file as if it were text')
     parser.add_argument('-v', '--verbose', action='store_true',
@@ -262,18 +1457,58 @@ def parse_args():
                         help="Quiet mode (ex: don't log proceed files)")
     parser.add_argument('--cython', action='store_true',
                         help="Search also in code generated by Cython")
+    parser.add_argument('--no-index', dest='use_index', action='store_false',
+                        help="Don't use the trigram index")
+    parser.add_argument('--scan', choices=('buffer', 'lines'), default='buffer',
+                        help="Search the regex in the whole member buffer, "
+                             "or line by line (default: %(default)s)")
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='Run N worker processes (default: number of CPUs)')
+    parser.add_argument('--window', metavar='N', type=int,
+                        help="Maximum number of tasks being searched or "
+                             "waiting for their results to be written "
+                             "(default: 2 x number of jobs)")
+    add_cache_args(parser)
+
+    args = parser.parse_intermixed_args()
+    patterns = []
+    if args.pattern is not None:
+        patterns.append(os.fsencode(args.pattern))
+    if args.patterns_file:
+        patterns.extend(read_patterns(args.patterns_file))
+    if not patterns:
+        parser.error("no regex: pass REGEX or --patterns-file")
+    try:
+        combine_patterns(patterns)
+    except (re.error, ValueError) as exc:
+        parser.error(f"invalid regex: {exc}")
+    args.patterns = patterns
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be greater than or equal to 1")
+    if args.window is None:
+        args.window = 2 * (args.jobs or os.cpu_count() or 1)
+    if args.window < 1:
+        parser.error("--window must be greater than or equal to 1")
+    check_cache_args(args)
+    args.command = "search"
+    return args
 
-    return parser.parse_args()
+
+def index_main(args):
+    start_time = datetime.datetime.now()
+    archives, updated, members, removed = index_dir(args, args.pypi_dir)
+
+    dt = datetime.datetime.now() - start_time
+    print()
+    print(f"Time: {dt}")
+    print(f"Indexed {members} members of {updated} archives "
+          f"({archives - updated} archives already up to date)")
+    if removed:
+        print(f"Removed {removed} outdated index files")
 
 
 def _main():
     args = parse_args()
-    output_filename = args.output
-    pattern = os.fsencode(args.pattern)
-    pypi_dir = args.pypi_dir
-    if args.cython:
-        global IGNORE_CYTHON
-        IGNORE_CYTHON = False
 
     if args.quiet:
         level = logging.ERROR
@@ -283,16 +1518,32 @@ def _main():
         level = logging.WARNING
     logger.setLevel(level)
 
-    start_time = datetime.datetime.now()
-    lines, projects, results = search_dir(args, pypi_dir, pattern)
+    if args.command == "index":
+        index_main(args)
+        return
 
+    output_filename = args.output
+    patterns = args.patterns
+    pypi_dir = args.pypi_dir
+    if args.cython:
+        global IGNORE_CYTHON
+        IGNORE_CYTHON = False
+
+    start_time = datetime.datetime.now()
     if output_filename:
         with open(output_filename, "w", encoding="utf8") as output:
-            print("\n".join(results), file=output, flush=True)
+            lines, projects, pattern_stats = search_dir(args, pypi_dir, patterns, output)
+    else:
+        lines, projects, pattern_stats = search_dir(args, pypi_dir, patterns)
 
     dt = datetime.datetime.now() - start_time
     print()
     print(f"Time: {dt}")
+    if len(patterns) > 1:
+        print(f"Patterns ({len(patterns)}):")
+        for pattern, (pattern_lines, pattern_projects) in zip(patterns, pattern_stats):
+            print(f"- {format_pattern(pattern)}: {pattern_lines} matching lines "
+                  f"in {len(pattern_projects)} projects")
     print(f"Found {lines} matching lines in {len(projects)} projects")
     if output_filename:
         print(f"Output written into: {output_filename}")
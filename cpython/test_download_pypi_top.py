@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+"""
+Tests of download_pypi_top.py against a local HTTP stand-in of PyPI.
+
+Usage::
+
+    python3 -m unittest -v test_download_pypi_top
+"""
+import asyncio
+import contextlib
+import hashlib
+import http.server
+import importlib.util
+import io
+import json
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+if importlib.util.find_spec("aiohttp") is None:
+    raise unittest.SkipTest("aiohttp is missing")
+import download_pypi_top  # noqa
+
+
+def create_sdist(project, version):
+    return (b"%s-%s: PyUnicode_AS_UNICODE(x);\n" % (project.encode(), version.encode())) * 100
+
+
+class FakePyPI(http.server.ThreadingHTTPServer):
+    """
+    Serve the top list, the PyPI JSON of projects and their sdists.
+
+    Project "p1" is redirected, project "p2" JSON is sent with chunked
+    encoding, the last project has no sdist.
+    """
+    daemon_threads = True
+
+    def __init__(self, nproject):
+        super().__init__(("127.0.0.1", 0), FakePyPIHandler)
+        self.projects = [f"p{index}" for index in range(nproject)]
+        self.versions = {project: "1.0" for project in self.projects[:-1]}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}"
+
+    def sdist_name(self, project):
+        return f"{project}-{self.versions[project]}.tar.gz"
+
+    def get_sdist(self, name):
+        project, _, version = name.removesuffix('.tar.gz').partition('-')
+        if self.versions.get(project) != version:
+            return None
+        return create_sdist(project, version)
+
+    def project_json(self, project):
+        if project not in self.versions:
+            return {"info": {"version": "1.0"},
+                    "urls": [{"packagetype": "bdist_wheel", "url": "x"}]}
+        name = self.sdist_name(project)
+        data = self.get_sdist(name)
+        path = "redirect" if project == "p1" else "files"
+        return {"info": {"version": self.versions[project]},
+                "urls": [{"packagetype": "sdist",
+                          "url": f"{self.url}/{path}/{name}",
+                          "size": len(data),
+                          "digests": {"sha256": hashlib.sha256(data).hexdigest()}}]}
+
+
+class FakePyPIHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=b"", headers=(), chunked=False):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for pos in range(0, len(body), 100):
+                chunk = body[pos:pos + 100]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get("Range"),
+                                    self.headers.get("If-None-Match")))
+        parts = self.path.split('/')
+        if self.path == "/top.json":
+            rows = [{"project": project} for project in server.projects]
+            self.send(200, json.dumps({"rows": rows}).encode())
+        elif parts[1] == "pypi":
+            project = parts[2]
+            body = json.dumps(server.project_json(project)).encode()
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                self.send(304, headers=[("ETag", etag)])
+            else:
+                self.send(200, body, [("ETag", etag)], chunked=(project == "p2"))
+        elif parts[1] == "redirect":
+            self.send(302, headers=[("Location", f"/files/{parts[2]}")])
+        elif parts[1] == "files":
+            data = server.get_sdist(parts[2])
+            if data is None:
+                self.send(404)
+                return
+            byte_range = self.headers.get("Range")
+            if not byte_range:
+                self.send(200, data)
+                return
+            start = int(byte_range.removeprefix("bytes=").split("-")[0])
+            if start >= len(data):
+                self.send(416, headers=[("Content-Range", f"bytes */{len(data)}")])
+            else:
+                self.send(206, data[start:],
+                          [("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")])
+        else:
+            self.send(404)
+
+
+class DownloadTests(unittest.TestCase):
+    NPROJECT = 6
+
+    def setUp(self):
+        self.server = FakePyPI(self.NPROJECT)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.dst_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dst_dir)
+
+    def download(self, *options):
+        argv = ["download_pypi_top.py", "--no-cache",
+                "--top-url", f"{self.server.url}/top.json",
+                "--index-url", f"{self.server.url}/pypi",
+                *options, self.dst_dir]
+        with mock.patch.object(sys, "argv", argv):
+            args = download_pypi_top.parse_args()
+        stats = download_pypi_top.Stats()
+        self.server.requests.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(download_pypi_top.download_all(args, stats))
+        return stats
+
+    def sdist_path(self, project):
+        return os.path.join(self.dst_dir, self.server.sdist_name(project))
+
+    def check_sdists(self):
+        names = sorted(name for name in os.listdir(self.dst_dir)
+                       if not name.startswith('.'))
+        expected = sorted(self.server.sdist_name(project)
+                          for project in self.server.versions)
+        self.assertEqual(names, expected)
+        for project, version in self.server.versions.items():
+            with open(self.sdist_path(project), "rb") as fp:
+                self.assertEqual(fp.read(), create_sdist(project, version))
+
+    def test_download(self):
+        stats = self.download()
+        self.check_sdists()
+        self.assertEqual(stats.downloads, self.NPROJECT - 1)
+        self.assertEqual(stats.failed, 0)
+
+        # Second run: sdists already exist
+        stats = self.download()
+        self.assertEqual(stats.downloads, 0)
+        self.assertEqual(stats.exists, self.NPROJECT - 1)
+
+    def test_resume(self):
+        project = "p0"
+        data = create_sdist(project, "1.0")
+        part = self.sdist_path(project) + download_pypi_top.PART_SUFFIX
+        with open(part, "wb") as fp:
+            fp.write(data[:100])
+        # Part file bigger than the sdist: removed and downloaded again
+        part2 = self.sdist_path("p3") + download_pypi_top.PART_SUFFIX
+        with open(part2, "wb") as fp:
+            fp.write(b"x" * 100_000)
+
+        stats = self.download()
+        self.check_sdists()
+        self.assertEqual(stats.resumed, 1)
+        self.assertIn((f"/files/{self.server.sdist_name(project)}", "bytes=100-", None),
+                      self.server.requests)
+
+    def test_sync(self):
+        self.download("--sync")
+        self.check_sdists()
+        with open(os.path.join(self.dst_dir, download_pypi_top.MANIFEST_FILENAME)) as fp:
+            manifest = json.load(fp)["projects"]
+        self.assertEqual(sorted(manifest), sorted(self.server.versions))
+        self.assertEqual(manifest["p0"]["sha256"],
+                         hashlib.sha256(create_sdist("p0", "1.0")).hexdigest())
+
+        # Nothing changed: conditional requests, no download
+        stats = self.download("--sync")
+        self.assertEqual(stats.downloads, 0)
+        self.assertEqual(stats.unchanged, self.NPROJECT - 1)
+        json_requests = [request for request in self.server.requests
+                         if request[0].startswith("/pypi/p0/")]
+        self.assertIsNotNone(json_requests[0][2])
+
+        # New version of p0, p4 left the top list
+        old_p0 = self.sdist_path("p0")
+        old_p4 = self.sdist_path("p4")
+        self.server.versions["p0"] = "2.0"
+        self.server.projects.remove("p4")
+        del self.server.versions["p4"]
+        stats = self.download("--sync")
+        self.assertEqual(stats.downloads, 1)
+        self.assertEqual(stats.pruned, 2)
+        self.assertFalse(os.path.exists(old_p0))
+        self.assertFalse(os.path.exists(old_p4))
+        self.check_sdists()
+
+
+if __name__ == "__main__":
+    unittest.main()